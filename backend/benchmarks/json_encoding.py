@@ -0,0 +1,66 @@
+import argparse
+import json
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from server import FastJSONResponse
+
+# Compares rendering a /api/dashboard/usage response the old way (jsonable_encoder
+# + stdlib json) with FastJSONResponse (orjson).
+# Run from the backend directory: `python benchmarks/json_encoding.py --logs 1000`.
+
+def usage_log(index: int, now: datetime) -> dict:
+    return {
+        "_id": str(uuid.uuid4()),
+        "teacher_id": str(uuid.uuid4()),
+        "student_hash": "ABCDE",
+        "url": f"https://www.example{index % 50}.com/articles/{index}",
+        "title": f"Example article number {index}",
+        "timestamp": now - timedelta(seconds=index * 37),
+        "duration": index % 600,
+        "is_blocked": index % 9 == 0
+    }
+
+def dashboard_payload(logs: int) -> dict:
+    now = datetime.utcnow()
+    usage_logs = [usage_log(index, now) for index in range(logs)]
+    return {
+        "total_usage": logs,
+        "blocked_attempts": sum(1 for log in usage_logs if log["is_blocked"]),
+        "top_domains": [{"domain": f"example{index}.com", "count": 100 - index, "blocked": 0} for index in range(10)],
+        "recent_logs": usage_logs,
+        "blocked_logs": [log for log in usage_logs if log["is_blocked"]]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Dashboard JSON rendering benchmark")
+    parser.add_argument("--logs", type=int, default=1000, help="Usage logs in the payload")
+    parser.add_argument("--repeat", type=int, default=200, help="Renders per measurement")
+    args = parser.parse_args()
+
+    payload = dashboard_payload(args.logs)
+    before = lambda: JSONResponse(jsonable_encoder(payload)).body
+    after = lambda: FastJSONResponse(payload).body
+
+    # Both paths must produce the same document
+    assert json.loads(before()) == json.loads(after())
+
+    results = {}
+    for name, render in (("jsonable_encoder + json", before), ("FastJSONResponse (orjson)", after)):
+        seconds = min(timeit.repeat(render, number=args.repeat, repeat=5)) / args.repeat
+        results[name] = seconds
+        print(f"{name:28} {seconds * 1000:8.3f} ms/response  ({len(render())} bytes)")
+
+    baseline, fast = results.values()
+    print(f"speedup: {baseline / fast:.1f}x")
+
+if __name__ == "__main__":
+    main()
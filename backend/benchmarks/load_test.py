@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import server
+
+# Load test for the extension and dashboard endpoints.
+#
+# Seeds N teachers x M students x K days of usage into an in-memory
+# mongomock-motor database (default) or a real mongod (--mongo URL), then
+# drives each endpoint at a fixed concurrency through an async client and
+# reports p50/p95/p99 latency and requests/sec. Results are written as JSON
+# so runs can be compared with --compare.
+#
+# Run from the backend directory:
+#   pip install -r benchmarks/requirements.txt
+#   python benchmarks/load_test.py --teachers 20 --students 30 --days 7 --output results.json
+#
+# Against a local mongod use a throwaway database, it is dropped before seeding:
+#   DATABASE_NAME=butterfly_bench python benchmarks/load_test.py --mongo mongodb://localhost:27017
+
+DOMAINS = [
+    "www.khanacademy.org", "en.wikipedia.org", "scholar.google.com", "www.youtube.com",
+    "www.facebook.com", "twitter.com", "docs.google.com", "classroom.google.com",
+    "www.nationalgeographic.com", "www.bbc.co.uk", "rediff.com", "gaming.example.com"
+]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def connect(mongo: str):
+    if mongo == "mock":
+        from mongomock_motor import AsyncMongoMockClient
+        # mongomock has no $topN; use the concurrent-query path for student activity
+        server.topn_supported = False
+        return AsyncMongoMockClient()
+    server.MONGO_URL = mongo
+    return server.create_mongo_client()
+
+async def seed(args) -> dict:
+    rng = random.Random(args.seed)
+    await server.client.drop_database(server.DATABASE_NAME)
+    await server.ensure_indexes()
+
+    now = datetime.utcnow()
+    teachers = []
+    for index in range(args.teachers):
+        teacher = {
+            "_id": str(uuid.uuid4()),
+            "email": f"teacher{index}@bench.example",
+            "password": "not-a-real-hash",
+            "name": f"Teacher {index}",
+            "school_name": f"School {index % 5}",
+            "hash_key": f"B{index:04d}",
+            "created_at": now
+        }
+        teachers.append(teacher)
+        await server.policies_collection.insert_one({
+            "_id": str(uuid.uuid4()),
+            "teacher_id": teacher["_id"],
+            "blocked_sites": ["rediff.com", "gaming.example.com"] + [f"blocked{n}.example.com" for n in range(200)],
+            "allowed_sites": {"Khan Academy": "https://www.khanacademy.org"},
+            "controlled_sites": ["facebook.com", "twitter.com", "youtube.com"],
+            "daily_time_limit": 3600,
+            "version": 1,
+            "created_at": now
+        })
+        await server.students_collection.insert_many([
+            {
+                "_id": str(uuid.uuid4()),
+                "teacher_id": teacher["_id"],
+                "teacher_hash": teacher["hash_key"],
+                "name": f"Student {index}-{student}",
+                "student_id": f"S{index:04d}{student:04d}",
+                "class_name": "Class A",
+                "grade": "8",
+                "created_at": now,
+                "last_active": None
+            }
+            for student in range(args.students)
+        ])
+
+        logs = []
+        for day in range(args.days):
+            for _ in range(args.students * args.events_per_student_day):
+                domain = rng.choice(DOMAINS)
+                logs.append({
+                    "_id": ObjectId(),
+                    "teacher_id": teacher["_id"],
+                    "student_hash": teacher["hash_key"],
+                    "url": f"https://{domain}/page/{rng.randint(1, 500)}",
+                    "title": f"Page on {domain}",
+                    "timestamp": now - timedelta(days=day, seconds=rng.randint(0, 86399)),
+                    "duration": rng.randint(0, 900),
+                    "is_blocked": domain in ("rediff.com", "gaming.example.com")
+                })
+        if logs:
+            await server.usage_collection.insert_many(await server.encode_usage_docs(logs))
+    await server.teachers_collection.insert_many(teachers)
+    await server.backfill_usage_rollups()
+
+    return {
+        "teachers": teachers,
+        "tokens": [server.create_teacher_token(teacher) for teacher in teachers]
+    }
+
+def scenarios(data: dict):
+    rng = random.Random(7)
+    teachers, tokens = data["teachers"], data["tokens"]
+
+    def log_usage():
+        teacher = rng.choice(teachers)
+        return "POST", "/api/extension/usage", {"json": {
+            "student_hash": teacher["hash_key"],
+            "url": f"https://{rng.choice(DOMAINS)}/page/{rng.randint(1, 500)}",
+            "title": "Bench page",
+            "timestamp": datetime.utcnow().isoformat(),
+            "duration": rng.randint(0, 300),
+            "is_blocked": False
+        }}
+
+    def get_extension_policy():
+        return "POST", "/api/extension/policy", {"json": {"hash_key": rng.choice(teachers)["hash_key"]}}
+
+    def get_usage_analytics():
+        return "GET", "/api/dashboard/usage", {"headers": {"Authorization": f"Bearer {rng.choice(tokens)}"}}
+
+    def get_student_activity():
+        return "GET", "/api/dashboard/students/activity", {"headers": {"Authorization": f"Bearer {rng.choice(tokens)}"}}
+
+    return {
+        "log_usage": log_usage,
+        "get_extension_policy": get_extension_policy,
+        "get_usage_analytics": get_usage_analytics,
+        "get_student_activity": get_student_activity
+    }
+
+async def drive(http: httpx.AsyncClient, make_request, total: int, concurrency: int) -> dict:
+    latencies = []
+    statuses = {}
+    remaining = iter(range(total))
+
+    async def worker():
+        for _ in remaining:
+            method, path, kwargs = make_request()
+            started = time.perf_counter()
+            response = await http.request(method, path, **kwargs)
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "elapsed_seconds": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99": round(percentile(latencies, 0.99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0
+        },
+        "status_codes": {str(code): count for code, count in sorted(statuses.items())}
+    }
+
+def compare(results: dict, previous_path: str):
+    with open(previous_path) as f:
+        previous = json.load(f)["results"]
+    print(f"\nChange vs {previous_path}:")
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        for metric in ("p50", "p95", "p99"):
+            before, after = previous[name]["latency_ms"][metric], result["latency_ms"][metric]
+            change = (after - before) / before * 100 if before else 0.0
+            print(f"  {name:22} {metric}  {before:9.3f} -> {after:9.3f} ms  ({change:+.1f}%)")
+
+async def run(args) -> dict:
+    server.init_database(connect(args.mongo))
+    # Every request comes from this one client; measure the endpoints, not the rate limits
+    server.ip_limiter.rate = server.hash_key_limiter.rate = 0
+    data = await seed(args)
+    selected = scenarios(data)
+    if args.endpoints:
+        selected = {name: selected[name] for name in args.endpoints}
+
+    results = {}
+    async with server.app.router.lifespan_context(server.app):
+        transport = httpx.ASGITransport(app=server.app) if not args.base_url else None
+        async with httpx.AsyncClient(transport=transport, base_url=args.base_url or "http://bench", timeout=60) as http:
+            for name, make_request in selected.items():
+                # Warm caches and connection pools before measuring
+                await drive(http, make_request, min(args.requests, args.concurrency * 2), args.concurrency)
+                results[name] = await drive(http, make_request, args.requests, args.concurrency)
+                latency = results[name]["latency_ms"]
+                print(
+                    f"{name:22} {results[name]['requests_per_second']:9.1f} req/s  "
+                    f"p50 {latency['p50']:8.3f}  p95 {latency['p95']:8.3f}  p99 {latency['p99']:8.3f} ms  "
+                    f"{results[name]['status_codes']}"
+                )
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Butterfly Buddy backend load test")
+    parser.add_argument("--mongo", default="mock", help="'mock' for mongomock-motor or a MongoDB URL")
+    parser.add_argument("--base-url", help="Drive a running server over HTTP instead of in-process (seeds --mongo)")
+    parser.add_argument("--teachers", type=int, default=10)
+    parser.add_argument("--students", type=int, default=30, help="Students per teacher")
+    parser.add_argument("--days", type=int, default=7, help="Days of usage history to seed")
+    parser.add_argument("--events-per-student-day", type=int, default=5)
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--endpoints", nargs="+", choices=["log_usage", "get_extension_policy", "get_usage_analytics", "get_student_activity"])
+    parser.add_argument("--seed", type=int, default=42, help="Random seed for the generated data")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Print latency changes against a previous results file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+        with open(args.output, "w") as f:
+            json.dump({
+                "timestamp": datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "config": config,
+                "results": results
+            }, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+if __name__ == "__main__":
+    main()
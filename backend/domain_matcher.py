@@ -0,0 +1,80 @@
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+# Domain matching for blocked/controlled site lists.
+#
+# Rules and visited URLs are reduced to normalized hostnames, and a rule
+# matches a host when it equals the host or is a suffix of it on a label
+# boundary ("x.com" matches "x.com" and "api.x.com" but not "box.com").
+# Rules live in a hashed set, so a lookup costs one set probe per label of
+# the host regardless of how long the list is. js/domain-matcher.js mirrors
+# this logic and consumes the compiled payload shipped with the policy.
+
+MATCHER_FORMAT = "suffix-set/1"
+
+STRIPPED_PREFIXES = ("*.", "www.")
+
+def normalize_host(value: str) -> str:
+    value = (value or "").strip().lower()
+    if "://" in value:
+        try:
+            value = urlsplit(value).hostname or ""
+        except ValueError:  # e.g. an unclosed IPv6 bracket; matches js/domain-matcher.js
+            return ""
+    else:
+        value = value.split("/", 1)[0].split("?", 1)[0].split(":", 1)[0]
+    value = value.strip(".")
+    for prefix in STRIPPED_PREFIXES:
+        if value.startswith(prefix):
+            value = value[len(prefix):]
+    return value
+
+def compile_rules(domains: Iterable[str]) -> List[str]:
+    # Normalize, dedupe and drop rules already covered by a parent domain
+    rules = {normalize_host(domain) for domain in domains}
+    rules.discard("")
+    compiled = set()
+    for rule in sorted(rules, key=lambda rule: rule.count(".")):
+        if match_suffix(compiled, rule) is None:
+            compiled.add(rule)
+    return sorted(compiled)
+
+def match_suffix(rules, host: str) -> Optional[str]:
+    # Walk the host's label-boundary suffixes: a.b.c -> b.c -> c
+    start = 0
+    while True:
+        suffix = host[start:]
+        if suffix in rules:
+            return suffix
+        dot = host.find(".", start)
+        if dot < 0:
+            return None
+        start = dot + 1
+
+class DomainMatcher:
+    def __init__(self, blocked_sites: Iterable[str] = (), controlled_sites: Iterable[str] = ()):
+        self.blocked = compile_rules(blocked_sites)
+        self.controlled = compile_rules(controlled_sites)
+        self._blocked = frozenset(self.blocked)
+        self._controlled = frozenset(self.controlled)
+
+    def match_blocked(self, url: str) -> Optional[str]:
+        host = normalize_host(url)
+        return match_suffix(self._blocked, host) if host else None
+
+    def match_controlled(self, url: str) -> Optional[str]:
+        host = normalize_host(url)
+        return match_suffix(self._controlled, host) if host else None
+
+    def is_blocked(self, url: str) -> bool:
+        return self.match_blocked(url) is not None
+
+    def is_controlled(self, url: str) -> bool:
+        return self.match_controlled(url) is not None
+
+    def to_payload(self) -> Dict[str, object]:
+        return {
+            "format": MATCHER_FORMAT,
+            "blocked": self.blocked,
+            "controlled": self.controlled
+        }
@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+from datetime import datetime
+
+import server
+
+# Maintenance commands for the Butterfly Buddy backend.
+# Run from the backend directory, e.g. `python manage.py backfill-rollups`.
+
+def parse_date(value: str) -> datetime:
+    return datetime.fromisoformat(value)
+
+async def ensure_indexes(args):
+    for entry in await server.ensure_indexes():
+        keys = ", ".join(f"{field}:{direction}" for field, direction in entry["keys"])
+        print(f"{entry['status']:6} {entry['collection']:15} {keys}  {entry.get('error', '')}")
+
+async def explain(args):
+    plans = await server.explain_hot_queries()
+    for plan in plans:
+        marker = "COLLSCAN" if plan["collscan"] else "ok"
+        print(f"{marker:9} {plan['name']:26} {' > '.join(plan['stages'])}  {', '.join(plan['indexes'])}")
+    if any(plan["collscan"] for plan in plans):
+        raise SystemExit(1)
+
+async def backfill_rollups(args):
+    await server.ensure_indexes()
+    written = await server.backfill_usage_rollups(args.start, args.end)
+    print(f"Wrote {written} rollup buckets")
+
+async def compact_usage(args):
+    await server.ensure_indexes()
+    written = await server.compact_usage()
+    print(f"Wrote {written} daily usage summaries")
+
+async def migrate_usage_schema(args):
+    # Safe to run while the servers are up; they already write the compact format
+    await server.ensure_indexes()
+    migrated = await server.migrate_usage_schema(args.batch_size)
+    print(f"Migrated {migrated} usage logs")
+    for name in await server.drop_legacy_usage_indexes():
+        print(f"Dropped index {name}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Butterfly Buddy backend maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("ensure-indexes", help="Create the indexes declared in server.INDEXES").set_defaults(handler=ensure_indexes)
+    commands.add_parser("explain", help="Explain hot queries and fail if any use a COLLSCAN").set_defaults(handler=explain)
+
+    backfill = commands.add_parser("backfill-rollups", help="Build usage rollups from existing usage_logs")
+    backfill.add_argument("--start", type=parse_date, help="First day to rebuild (ISO date, default: oldest log)")
+    backfill.add_argument("--end", type=parse_date, help="Stop before this time (ISO date, default: start of the current hour)")
+    backfill.set_defaults(handler=backfill_rollups)
+
+    commands.add_parser("compact-usage", help="Fold usage older than the hot window into daily summaries").set_defaults(handler=compact_usage)
+
+    migrate = commands.add_parser("migrate-usage-schema", help="Rewrite usage_logs in the compact document format")
+    migrate.add_argument("--batch-size", type=int, default=1000, help="Documents rewritten per batch")
+    migrate.set_defaults(handler=migrate_usage_schema)
+
+    args = parser.parse_args()
+    server.init_database(server.create_mongo_client())
+    asyncio.run(args.handler(args))
+
+if __name__ == "__main__":
+    main()
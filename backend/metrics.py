@@ -0,0 +1,156 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+# Prometheus metrics for the backend: per-route HTTP latency, in-flight and
+# status counts (MetricsMiddleware), Mongo command latency per collection and
+# command (MongoCommandListener), and time spent in named request stages such
+# as auth and serialization (observe_stage). In-process component stats (the
+# usage buffer, caches, ...) are exported as gauges through StatsCollector.
+#
+# With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty
+# directory; /metrics then aggregates every worker's counters and histograms.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "butterfly_http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "butterfly_http_requests_in_flight",
+    "HTTP requests currently being handled",
+    multiprocess_mode="livesum",
+)
+HTTP_RESPONSES = Counter(
+    "butterfly_http_responses_total",
+    "HTTP responses by route and status code",
+    ["method", "route", "status"],
+)
+MONGO_COMMAND_DURATION = Histogram(
+    "butterfly_mongo_command_duration_seconds",
+    "MongoDB command latency by collection and command",
+    ["collection", "command"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "butterfly_mongo_command_failures_total",
+    "Failed MongoDB commands by collection and command",
+    ["collection", "command"],
+)
+REQUEST_STAGE_DURATION = Histogram(
+    "butterfly_request_stage_duration_seconds",
+    "Time spent in a request stage (auth, serialization, ...)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+@contextmanager
+def observe_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REQUEST_STAGE_DURATION.labels(stage).observe(time.perf_counter() - started)
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, so streaming responses pass through untouched
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            # Label by route template, not raw path, to keep cardinality bounded
+            route = scope.get("route")
+            route_path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUEST_DURATION.labels(method, route_path).observe(time.perf_counter() - started)
+            HTTP_RESPONSES.labels(method, route_path, str(status_code)).inc()
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore carries the collection separately; admin commands have none
+            collection = event.command.get("collection", "")
+        self._pending[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), "")
+        MONGO_COMMAND_DURATION.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+mongo_listener = MongoCommandListener()
+
+class StatsCollector:
+    # Exposes numeric values from stats() dicts as gauges, e.g.
+    # usage_buffer.stats()["flush_latency_ms"]["avg"] -> butterfly_usage_buffer_flush_latency_ms_avg
+    def __init__(self, sources: Dict[str, Callable[[], dict]]):
+        self.sources = sources
+
+    def collect(self):
+        for source, stats in self.sources.items():
+            for name, value in self._flatten(f"butterfly_{source}", stats()):
+                yield GaugeMetricFamily(name, f"{source} stat", value=value)
+
+    def _flatten(self, prefix: str, stats: dict):
+        for key, value in stats.items():
+            name = f"{prefix}_{key}"
+            if isinstance(value, dict):
+                yield from self._flatten(name, value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield name, value
+
+def register_stats(sources: Dict[str, Callable[[], dict]]):
+    # Per-process values; not aggregated across workers in multiprocess mode
+    REGISTRY.register(StatsCollector(sources))
+
+def render_latest() -> bytes:
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
@@ -0,0 +1,109 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Statistical stack sampler for profiling a live worker.
+#
+# A background thread wakes every `interval` seconds, grabs the current frame of
+# the event-loop thread via sys._current_frames() and counts the stack. Nothing
+# runs unless a profile is in progress, so there is no cost when disabled.
+# Samples taken while the loop is idle in select()/epoll are dropped, so the
+# profile shows where request handling actually spends CPU.
+#
+# Each uvicorn worker is a separate process with its own sampler; a profile
+# covers only the worker that served the request (its pid is reported).
+
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "_run_once"}
+
+def frame_label(code) -> str:
+    path = code.co_filename
+    parts = path.replace("\\", "/").rsplit("/", 2)
+    short = "/".join(parts[-2:]) if len(parts) > 1 else path
+    return f"{code.co_name} ({short}:{code.co_firstlineno})"
+
+class StackSampler:
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.duration = 0.0
+
+    def run(self, seconds: float):
+        started = time.perf_counter()
+        deadline = started + seconds
+        while time.perf_counter() < deadline:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            self.samples += 1
+            if stack and stack[0].split(" ", 1)[0] in IDLE_FUNCTIONS:
+                self.idle_samples += 1
+                continue
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+        self.duration = time.perf_counter() - started
+
+    def collapsed(self) -> str:
+        # Brendan Gregg's collapsed format, readable by flamegraph.pl and speedscope
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def speedscope(self, name: str) -> dict:
+        frames, frame_index, samples, weights = [], {}, [], []
+        for stack, count in self.stacks.most_common():
+            indexes = []
+            for label in stack.split(";"):
+                if label not in frame_index:
+                    frame_index[label] = len(frames)
+                    frames.append({"name": label})
+                indexes.append(frame_index[label])
+            samples.append(indexes)
+            weights.append(round(count * self.interval, 6))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "butterfly-buddy",
+            "name": name,
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(sum(weights), 6),
+                "samples": samples,
+                "weights": weights
+            }]
+        }
+
+    def summary(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "duration_seconds": round(self.duration, 3),
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "idle_samples": self.idle_samples
+        }
+
+class Profiler:
+    # One profile at a time per worker
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        return self._lock.acquire(blocking=False)
+
+    def release(self):
+        self._lock.release()
+
+    @property
+    def active(self) -> bool:
+        return self._lock.locked()
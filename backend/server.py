@@ -1,21 +1,131 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
+from bson import Binary, ObjectId
+from pymongo import ASCENDING, DESCENDING, ReadPreference, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pydantic import BaseModel, EmailStr, Field, ValidationError
+from typing import List, Optional, Dict, Any, Iterable
+from datetime import datetime, timedelta, timezone
 import os
 import bcrypt
+import orjson
 import shortuuid
 from jose import JWTError, jwt
 from dotenv import load_dotenv
 import uuid
 import re
+import asyncio
+import logging
+import time
+import threading
+import json
+import hmac
+import csv
+import io
+import zlib
+import base64
+import socket
+import math
+import binascii
+import codecs
+from collections import OrderedDict, deque, namedtuple
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from domain_matcher import DomainMatcher, normalize_host
+from profiler import Profiler, StackSampler
+from sketches import CountMinSketch, HyperLogLog, TopK
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Optional: only needed to share the policy hub across workers
+    aioredis = None
 
 load_dotenv()
 
-app = FastAPI(title="Butterfly Buddy Backend", version="1.0.0")
+logger = logging.getLogger("butterfly_buddy")
+
+# Fast JSON responses
+# orjson serializes dicts, lists and datetimes natively, producing the same
+# ISO 8601 output as jsonable_encoder at a fraction of the CPU cost. Handlers
+# that return large Mongo documents return FastJSONResponse directly so
+# FastAPI skips jsonable_encoder; bytes are sent as already-serialized JSON.
+def orjson_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dump_json(content) -> bytes:
+    return orjson.dumps(content, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        with metrics.observe_stage("serialization"):
+            return dump_json(content)
+
+class GzipRequestMiddleware:
+    # Inflates request bodies sent with Content-Encoding: gzip (the extension
+    # uploads usage batches compressed) as they arrive, in pieces of at most
+    # CHUNK_BYTES. The inflated size is capped except on STREAMED_PATHS, whose
+    # handlers consume the body incrementally.
+    STREAMED_PATHS = {"/api/students/import"}
+    CHUNK_BYTES = 64 * 1024
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        headers = scope.get("headers", []) if scope["type"] == "http" else []
+        if not any(name == b"content-encoding" and value.strip().lower() == b"gzip" for name, value in headers):
+            await self.app(scope, receive, send)
+            return
+
+        limit = None if scope["path"] in self.STREAMED_PATHS else GZIP_REQUEST_MAX_BYTES
+        decompressor = zlib.decompressobj(wbits=31)
+        inflated = 0
+        more_body = True
+
+        async def receive_inflated():
+            nonlocal inflated, more_body
+            while True:
+                if decompressor.unconsumed_tail:
+                    data = decompressor.unconsumed_tail
+                elif more_body:
+                    message = await receive()
+                    if message["type"] != "http.request":
+                        return message
+                    more_body = message.get("more_body", False)
+                    data = message.get("body", b"")
+                elif not decompressor.eof:
+                    raise HTTPException(status_code=400, detail="Invalid gzip request body")
+                else:
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                try:
+                    body = decompressor.decompress(data, self.CHUNK_BYTES)
+                except zlib.error:
+                    raise HTTPException(status_code=400, detail="Invalid gzip request body")
+                inflated += len(body)
+                if limit is not None and inflated > limit:
+                    raise HTTPException(status_code=413, detail="Request body too large")
+                if body:
+                    return {"type": "http.request", "body": body, "more_body": True}
+
+        # Modified in place: the router records the matched route on this scope,
+        # and MetricsMiddleware reads it from the same dict
+        scope["headers"] = [(name, value) for name, value in headers if name not in (b"content-encoding", b"content-length")]
+        await self.app(scope, receive_inflated, send)
+
+app = FastAPI(
+    title="Butterfly Buddy Backend",
+    version="1.0.0",
+    default_response_class=FastJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -24,23 +134,140 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
+app.add_middleware(GzipRequestMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 
 # MongoDB connection
 MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "butterfly_buddy")
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
+USAGE_BATCH_MAX_EVENTS = int(os.getenv("USAGE_BATCH_MAX_EVENTS", 1000))
+USAGE_QUEUE_MAX_SIZE = int(os.getenv("USAGE_QUEUE_MAX_SIZE", 10000))
+USAGE_FLUSH_BATCH_SIZE = int(os.getenv("USAGE_FLUSH_BATCH_SIZE", 500))
+USAGE_FLUSH_INTERVAL_MS = int(os.getenv("USAGE_FLUSH_INTERVAL_MS", 250))
+# Largest inflated size accepted for a gzip-encoded request body
+GZIP_REQUEST_MAX_BYTES = int(os.getenv("GZIP_REQUEST_MAX_BYTES", 4 * 1024 * 1024))
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", 90))
+USAGE_HOT_WINDOW_DAYS = int(os.getenv("USAGE_HOT_WINDOW_DAYS", 7))
+USAGE_COMPACTION_INTERVAL_SECONDS = float(os.getenv("USAGE_COMPACTION_INTERVAL_SECONDS", 3600))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", 32))
+ACTIVITY_QUERY_CONCURRENCY = int(os.getenv("ACTIVITY_QUERY_CONCURRENCY", 8))
+# Largest page a client may request from the paginated listing endpoints
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 500))
+# Roster import: rows written per insert_many/bulk_write, and per-row errors listed in the report
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+IMPORT_MAX_ERRORS = int(os.getenv("IMPORT_MAX_ERRORS", 1000))
+CSV_MAX_RECORD_LINES = 100  # Lines one quoted CSV field may span
+IMPORT_MAX_LINE_LENGTH = 64 * 1024  # Characters per roster line; longer lines are rejected
+# Usage export: documents fetched per cursor batch
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+# Rollup backfill: raw logs read and folded per batch
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", 5000))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", 60))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+PRINCIPAL_CACHE_TTL_SECONDS = float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 300))
+# Approximate usage analytics (sketches) per teacher, school and overall
+SKETCH_FLUSH_SECONDS = float(os.getenv("SKETCH_FLUSH_SECONDS", 60))
+SKETCH_RETENTION_DAYS = int(os.getenv("SKETCH_RETENTION_DAYS", 35))
+SKETCH_QUERY_CACHE_SECONDS = float(os.getenv("SKETCH_QUERY_CACHE_SECONDS", 30))
+SKETCH_QUERY_CACHE_MAX_ENTRIES = int(os.getenv("SKETCH_QUERY_CACHE_MAX_ENTRIES", 256))  # ~6 KB per cached window
+# Extension rate limits (requests/second and burst size; a rate of 0 disables the limit)
+EXTENSION_RATE_PER_HASH_KEY = float(os.getenv("EXTENSION_RATE_PER_HASH_KEY", 20))
+EXTENSION_BURST_PER_HASH_KEY = float(os.getenv("EXTENSION_BURST_PER_HASH_KEY", 100))
+# Off by default: a school's devices usually share one NAT address, at ~0.05
+# requests/second each. When enabling it, size it for the largest school.
+EXTENSION_RATE_PER_IP = float(os.getenv("EXTENSION_RATE_PER_IP", 0))
+EXTENSION_BURST_PER_IP = float(os.getenv("EXTENSION_BURST_PER_IP", 2000))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+# Hash keys a worker has no bucket for yet, admitted per second (and burst) across
+# all keys, so a flood of made-up keys can't each start with a full burst
+EXTENSION_NEW_HASH_KEYS_PER_SECOND = float(os.getenv("EXTENSION_NEW_HASH_KEYS_PER_SECOND", 50))
+EXTENSION_NEW_HASH_KEYS_BURST = float(os.getenv("EXTENSION_NEW_HASH_KEYS_BURST", 1000))
+# Hash keys that matched no teacher are answered from memory for this long
+UNKNOWN_HASH_KEY_CACHE_SECONDS = float(os.getenv("UNKNOWN_HASH_KEY_CACHE_SECONDS", 30))
+# Load shedding: requests in flight per worker before extension traffic is refused
+# (0 disables); usage writes are refused from LOW_PRIORITY_SHED_FRACTION of that,
+# or once the usage write queue is that full
+MAX_IN_FLIGHT_REQUESTS = int(os.getenv("MAX_IN_FLIGHT_REQUESTS", 512))
+LOW_PRIORITY_SHED_FRACTION = float(os.getenv("LOW_PRIORITY_SHED_FRACTION", 0.75))
+# Server-side daily time counters for controlled sites
+TIME_COUNTER_FLUSH_SECONDS = float(os.getenv("TIME_COUNTER_FLUSH_SECONDS", 5))
+TIME_BUDGET_CACHE_SECONDS = float(os.getenv("TIME_BUDGET_CACHE_SECONDS", 5))
+TIME_USAGE_RETENTION_DAYS = int(os.getenv("TIME_USAGE_RETENTION_DAYS", 7))
+REDIS_URL = os.getenv("REDIS_URL")
+POLICY_STREAM_HEARTBEAT_SECONDS = float(os.getenv("POLICY_STREAM_HEARTBEAT_SECONDS", 25))
+POLICY_STREAM_MAX_SECONDS = float(os.getenv("POLICY_STREAM_MAX_SECONDS", 600))
+# Connection pool, one per worker process
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 0))  # 0 keeps idle connections open
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+# Read preference for dashboard analytics (usage logs and rollups); writes always go to the primary
+DASHBOARD_READ_PREFERENCE = os.getenv("DASHBOARD_READ_PREFERENCE", "secondaryPreferred")
+# Uvicorn worker processes when started with `python server.py`
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+# Uvicorn only runs the shutdown hooks (usage buffer drain etc.) once every
+# connection has closed, and policy streams stay open for up to
+# POLICY_STREAM_MAX_SECONDS; after this long the remaining ones are cut off
+# and clients reconnect to another worker
+GRACEFUL_SHUTDOWN_SECONDS = int(os.getenv("GRACEFUL_SHUTDOWN_SECONDS", 10))
+# On-demand sampling profiler (admin only)
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", 60))
 
-client = AsyncIOMotorClient(MONGO_URL)
-db = client[DATABASE_NAME]
 security = HTTPBearer()
 
-# Collections
-teachers_collection = db.teachers
-students_collection = db.students
-policies_collection = db.policies
-usage_collection = db.usage_logs
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST
+}
+
+def create_mongo_client() -> AsyncIOMotorClient:
+    return AsyncIOMotorClient(
+        MONGO_URL,
+        maxPoolSize=MONGO_MAX_POOL_SIZE,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGO_MAX_IDLE_TIME_MS or None,
+        serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        event_listeners=[metrics.mongo_listener]
+    )
+
+# Bound by the connect_database startup hook so each worker process opens its own
+# pool after it starts; scripts call init_database() themselves
+client: Optional[AsyncIOMotorClient] = None
+
+def init_database(mongo_client):
+    # Binds the module-level database handles; benchmarks pass their own client
+    global client, db, teachers_collection, students_collection, policies_collection
+    global usage_collection, rollups_collection, daily_usage_collection, maintenance_collection
+    global analytics_usage_collection, analytics_rollups_collection, time_usage_collection, sketches_collection
+    global url_prefixes_collection
+    client = mongo_client
+    db = client[DATABASE_NAME]
+    
+    # Collections
+    teachers_collection = db.teachers
+    students_collection = db.students
+    policies_collection = db.policies
+    usage_collection = db.usage_logs
+    rollups_collection = db.usage_rollups
+    daily_usage_collection = db.usage_daily
+    maintenance_collection = db.maintenance
+    time_usage_collection = db.device_time_usage
+    sketches_collection = db.usage_sketches
+    url_prefixes_collection = db.url_prefixes
+
+    # Dashboard analytics tolerate replication lag, so they can read from secondaries
+    analytics_db = client.get_database(DATABASE_NAME, read_preference=READ_PREFERENCES[DASHBOARD_READ_PREFERENCE])
+    analytics_usage_collection = analytics_db.usage_logs
+    analytics_rollups_collection = analytics_db.usage_rollups
 
 # Pydantic Models
 class TeacherCreate(BaseModel):
@@ -54,8 +281,8 @@ class TeacherLogin(BaseModel):
     password: str
 
 class StudentCreate(BaseModel):
-    name: str
-    student_id: str
+    name: str = Field(..., min_length=1)
+    student_id: str = Field(..., min_length=1)
     class_name: str
     grade: str
 
@@ -72,6 +299,12 @@ class UsageLog(BaseModel):
     timestamp: datetime
     duration: int = 0
     is_blocked: bool = False
+    # Random id the extension keeps per browser profile; student_hash is the
+    # class hash key, so this is what tells students' devices apart
+    device_id: Optional[str] = Field(None, max_length=64)
+
+class UsageBatch(BaseModel):
+    events: List[UsageLog] = Field(..., min_length=1, max_length=USAGE_BATCH_MAX_EVENTS)
 
 class HashKeyRequest(BaseModel):
     hash_key: str
@@ -83,6 +316,78 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
+# bcrypt costs 100-300 ms of CPU per call, so it runs on a small dedicated pool
+# (bcrypt releases the GIL) instead of the event loop. At most
+# workers + queue_limit calls may be pending; beyond that callers get a 503.
+class PasswordHasher:
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.capacity = workers + queue_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_wait_seconds_total = 0.0
+        self.queue_wait_seconds_max = 0.0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+
+    async def _run(self, func, *args):
+        if self.pending >= self.capacity:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many sign-in requests, retry shortly",
+                headers={"Retry-After": "1"}
+            )
+        
+        def timed():
+            started = time.perf_counter()
+            result = func(*args)
+            return started, time.perf_counter(), result
+        
+        self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            started, finished, result = await asyncio.get_running_loop().run_in_executor(self.executor, timed)
+        finally:
+            self.pending -= 1
+        
+        self.completed += 1
+        self.queue_wait_seconds_total += started - submitted
+        self.queue_wait_seconds_max = max(self.queue_wait_seconds_max, started - submitted)
+        self.hash_seconds_total += finished - started
+        self.hash_seconds_max = max(self.hash_seconds_max, finished - started)
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        return await self._run(verify_password, password, hashed)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "capacity": self.capacity,
+            "pending": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_ms": {
+                "avg": round(self.queue_wait_seconds_total / self.completed * 1000, 2) if self.completed else 0.0,
+                "max": round(self.queue_wait_seconds_max * 1000, 2)
+            },
+            "hash_ms": {
+                "avg": round(self.hash_seconds_total / self.completed * 1000, 2) if self.completed else 0.0,
+                "max": round(self.hash_seconds_max * 1000, 2)
+            }
+        }
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_LIMIT)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -96,7 +401,261 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
 def generate_hash_key() -> str:
     return shortuuid.ShortUUID().random(length=5).upper()
 
+def policy_etag(teacher_id: str, version: int) -> str:
+    return f'"{teacher_id[:8]}-{version}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in candidates or any(tag.removeprefix("W/") == etag for tag in candidates)
+
+def build_usage_doc(usage: UsageLog, teacher_id: str) -> dict:
+    return {
+        "_id": ObjectId(),
+        "teacher_id": teacher_id,
+        "student_hash": usage.student_hash,
+        "url": usage.url,
+        "title": usage.title,
+        "timestamp": usage.timestamp,
+        "duration": usage.duration,
+        "is_blocked": usage.is_blocked,
+        "device_id": usage.device_id
+    }
+
+async def update_last_active(usage_docs: List[dict]):
+    # Collapse last_active updates to the latest timestamp per student
+    last_active = {}
+    for doc in usage_docs:
+        current = last_active.get(doc["student_hash"])
+        if current is None or doc["timestamp"] > current:
+            last_active[doc["student_hash"]] = doc["timestamp"]
+    
+    if last_active:
+        await students_collection.bulk_write([
+            UpdateOne(
+                {"teacher_hash": student_hash, "$or": [{"last_active": None}, {"last_active": {"$lt": timestamp}}]},
+                {"$set": {"last_active": timestamp}}
+            )
+            for student_hash, timestamp in last_active.items()
+        ], ordered=False)
+
+def to_naive_utc(timestamp: datetime) -> datetime:
+    # Stored timestamps are naive UTC, whether the client sent an aware or naive value
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def usage_hour(timestamp: datetime) -> datetime:
+    return to_naive_utc(timestamp).replace(minute=0, second=0, microsecond=0)
+
+def usage_day(timestamp: datetime) -> datetime:
+    return usage_hour(timestamp).replace(hour=0)
+
+# Keyset pagination: a cursor is the (sort value, _id) of the last row served,
+# base64url-encoded so clients treat it as opaque
+def encode_cursor(value: Any, last_id: str) -> str:
+    return base64.urlsafe_b64encode(dump_json([value, last_id])).decode().rstrip("=")
+
+def decode_cursor(cursor: str, timestamp: bool = False) -> tuple:
+    try:
+        value, last_id = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        # Both parts end up in a query filter, so anything but plain strings
+        # (e.g. {"$ne": null}) would change what the query matches
+        if not isinstance(value, str) or not isinstance(last_id, str):
+            raise ValueError("cursor values must be strings")
+        if timestamp:
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, last_id
+
+def keyset_filter(field: str, value: Any, last_id: str, descending: bool = False) -> dict:
+    # Rows strictly after (value, last_id) in (field, _id) order
+    op = "$lt" if descending else "$gt"
+    return {"$or": [{field: {op: value}}, {field: value, "_id": {op: last_id}}]}
+
+def next_cursor(rows: List[dict], field: str, limit: int) -> Optional[str]:
+    if len(rows) < limit:
+        return None
+    return encode_cursor(rows[-1].get(field), rows[-1]["_id"])
+
+def rollup_key(usage_doc: dict) -> tuple:
+    return (
+        usage_doc["teacher_id"],
+        usage_hour(usage_doc["timestamp"]),
+        usage_doc["student_hash"],
+        normalize_host(usage_doc["url"])
+    )
+
+def rollup_update(key: tuple, counts: dict, upsert_op: str = "$inc") -> UpdateOne:
+    teacher_id, hour, student_hash, domain = key
+    return UpdateOne(
+        {"teacher_id": teacher_id, "hour": hour, "student_hash": student_hash, "domain": domain},
+        {upsert_op: counts},
+        upsert=True
+    )
+
+def aggregate_rollups(usage_docs, buckets: Optional[Dict[tuple, dict]] = None) -> Dict[tuple, dict]:
+    # Per teacher/hour/student/domain event, blocked and duration totals,
+    # added to buckets when given
+    buckets = {} if buckets is None else buckets
+    for doc in usage_docs:
+        counts = buckets.setdefault(rollup_key(doc), {"count": 0, "blocked": 0, "duration": 0})
+        counts["count"] += 1
+        counts["blocked"] += 1 if doc["is_blocked"] else 0
+        counts["duration"] += doc["duration"]
+    return buckets
+
+async def update_usage_rollups(usage_docs: List[dict]):
+    buckets = aggregate_rollups(usage_docs)
+    if buckets:
+        await rollups_collection.bulk_write([
+            rollup_update(key, counts) for key, counts in buckets.items()
+        ], ordered=False)
+
+async def record_usage_side_effects(usage_docs: List[dict]):
+    # Run after the events are stored. Each update is independent, so one
+    # failing (or one odd document) must not cost the others or fail the request
+    for update in (update_last_active, update_usage_rollups, time_counters.record, sketch_store.record):
+        try:
+            await update(usage_docs)
+        except Exception:
+            logger.exception("Usage side effect %s failed for %d events", update.__qualname__, len(usage_docs))
+
+async def backfill_usage_rollups(start: Optional[datetime] = None, end: Optional[datetime] = None) -> int:
+    # Rebuild rollups from raw usage_logs one day at a time. Buckets are
+    # overwritten ($set), so the backfill is safe to re-run over the same range.
+    # It stops at the start of the current hour, the one live writes still $inc
+    # (an earlier end is rounded down to the hour, so no bucket is half rebuilt).
+    # Logs that migrate-usage-schema has not rewritten yet (timestamp rather
+    # than ts) are counted too.
+    first = []
+    for field in ("ts", "timestamp"):
+        bounds = usage_collection.find({field: {"$exists": True}}, {field: 1}).sort(field, 1).limit(1)
+        first += [doc[field] for doc in await bounds.to_list(1)]
+    if not first:
+        return 0
+    day = usage_day(start or min(first))
+    current_hour = usage_hour(datetime.utcnow())
+    end = min(usage_hour(end), current_hour) if end else current_hour
+    
+    written = 0
+    while day < end:
+        next_day = min(day + timedelta(days=1), end)
+        query = {"$or": [{field: {"$gte": day, "$lt": next_day}} for field in ("ts", "timestamp")]}
+        cursor = usage_collection.find(query, {"n": 0, "title": 0}).batch_size(BACKFILL_BATCH_SIZE)
+        # Folded in a batch at a time; only the day's buckets are kept in memory
+        buckets = {}
+        while True:
+            batch = await cursor.to_list(BACKFILL_BATCH_SIZE)
+            if not batch:
+                break
+            aggregate_rollups(await decode_usage_docs(await skip_migrated_originals(batch)), buckets)
+        if buckets:
+            await rollups_collection.bulk_write([
+                rollup_update(key, counts, "$set") for key, counts in buckets.items()
+            ], ordered=False)
+            written += len(buckets)
+        day = next_day
+    return written
+
+async def skip_migrated_originals(stored_docs: List[dict]) -> List[dict]:
+    # An interrupted migration can leave both a log and its rewritten copy; count the copy
+    copy_ids = {migrated_usage_id(doc): doc["_id"] for doc in stored_docs if "teacher_id" in doc}
+    if not copy_ids:
+        return stored_docs
+    copies = await usage_collection.find({"_id": {"$in": list(copy_ids)}}, {"_id": 1}).to_list(None)
+    originals = {copy_ids[doc["_id"]] for doc in copies}
+    return [doc for doc in stored_docs if doc["_id"] not in originals]
+
+async def compact_usage_day(day: datetime) -> int:
+    # Fold one day of hourly rollups into per teacher/student/domain daily summaries
+    summaries = await rollups_collection.aggregate([
+        {"$match": {"hour": {"$gte": day, "$lt": day + timedelta(days=1)}}},
+        {"$group": {
+            "_id": {"teacher_id": "$teacher_id", "student_hash": "$student_hash", "domain": "$domain"},
+            "count": {"$sum": "$count"},
+            "blocked": {"$sum": "$blocked"},
+            "duration": {"$sum": "$duration"}
+        }}
+    ]).to_list(None)
+    if summaries:
+        await daily_usage_collection.bulk_write([
+            UpdateOne(
+                {**summary["_id"], "day": day},
+                {"$set": {"count": summary["count"], "blocked": summary["blocked"], "duration": summary["duration"]}},
+                upsert=True
+            )
+            for summary in summaries
+        ], ordered=False)
+    return len(summaries)
+
+async def compact_usage() -> int:
+    # Compact every full day that has left the hot window since the last run.
+    # Progress is kept in the maintenance collection; re-running a day is safe.
+    state = await maintenance_collection.find_one({"_id": "usage_compaction"})
+    if state:
+        day = state["compacted_through"] + timedelta(days=1)
+    else:
+        oldest = await rollups_collection.find({}, {"hour": 1}).sort("hour", 1).limit(1).to_list(1)
+        if not oldest:
+            return 0
+        day = oldest[0]["hour"].replace(hour=0)
+    
+    cutoff = usage_hour(datetime.utcnow() - timedelta(days=USAGE_HOT_WINDOW_DAYS)).replace(hour=0)
+    written = 0
+    while day < cutoff:
+        written += await compact_usage_day(day)
+        await maintenance_collection.update_one(
+            {"_id": "usage_compaction"},
+            {"$set": {"compacted_through": day, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        day += timedelta(days=1)
+    return written
+
+async def run_usage_compactor():
+    if 0 < USAGE_RETENTION_DAYS <= USAGE_HOT_WINDOW_DAYS:
+        logger.warning("USAGE_RETENTION_DAYS should exceed USAGE_HOT_WINDOW_DAYS or data expires before compaction")
+    while True:
+        try:
+            await compact_usage()
+        except Exception:
+            logger.exception("Usage compaction failed")
+        await asyncio.sleep(USAGE_COMPACTION_INTERVAL_SECONDS)
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # Admin/diagnostic routes are disabled unless ADMIN_TOKEN is configured
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid admin token")
+
+# Claims copied into access tokens so authenticated routes need no teacher lookup
+TOKEN_CLAIMS = ("hash_key", "name", "email", "school_name")
+
+def create_teacher_token(teacher_doc: dict, expires_delta: Optional[timedelta] = None) -> str:
+    claims = {"sub": teacher_doc["_id"], "epoch": teacher_doc.get("token_epoch", 0)}
+    claims.update({claim: teacher_doc[claim] for claim in TOKEN_CLAIMS})
+    return create_access_token(data=claims, expires_delta=expires_delta)
+
+async def get_token_epoch(teacher_id: str) -> Optional[int]:
+    # Current revocation epoch, cached briefly so the hot path does no I/O
+    epoch = token_epochs.get(teacher_id)
+    if epoch is None:
+        teacher = await teachers_collection.find_one({"_id": teacher_id}, {"token_epoch": 1})
+        if teacher is None:
+            return None
+        epoch = teacher.get("token_epoch", 0)
+        token_epochs.set(teacher_id, epoch)
+    return epoch
+
 async def get_current_teacher(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    with metrics.observe_stage("auth"):
+        return await authenticate_teacher(credentials)
+
+async def authenticate_teacher(credentials: HTTPAuthorizationCredentials):
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         teacher_id: str = payload.get("sub")
@@ -105,18 +664,1191 @@ async def get_current_teacher(credentials: HTTPAuthorizationCredentials = Depend
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Could not validate credentials",
             )
-        teacher = await teachers_collection.find_one({"_id": teacher_id})
+    except JWTError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+        )
+    
+    if not all(claim in payload for claim in TOKEN_CLAIMS):
+        # Token issued before claims were embedded; fall back to a lookup
+        teacher = await teachers_collection.find_one({"_id": teacher_id}, {"password": 0})
         if teacher is None:
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Teacher not found",
             )
+        token_epochs.set(teacher_id, teacher.get("token_epoch", 0))
         return teacher
-    except JWTError:
+    
+    epoch = await get_token_epoch(teacher_id)
+    if epoch is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
+            detail="Teacher not found",
+        )
+    if payload.get("epoch", 0) < epoch:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token has been revoked",
+        )
+    
+    principal = {"_id": teacher_id}
+    principal.update({claim: payload[claim] for claim in TOKEN_CLAIMS})
+    return principal
+
+# Index Provisioning
+# Every index the hot paths rely on, as (collection, keys, options). Created
+# idempotently at startup; `python manage.py explain` checks they are used.
+INDEXES = [
+    ("teachers", [("email", ASCENDING)], {"unique": True}),
+    ("teachers", [("hash_key", ASCENDING)], {"unique": True}),
+    ("policies", [("teacher_id", ASCENDING)], {"unique": True}),
+    # Listing indexes end in _id so keyset pages resolve ties inside the index
+    ("students", [("teacher_id", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)], {}),
+    ("students", [("teacher_hash", ASCENDING)], {}),
+    ("students", [("teacher_id", ASCENDING), ("student_id", ASCENDING)], {"unique": True}),
+    # usage_logs use the compact field names (see encode_usage_docs)
+    ("usage_logs", [("t", ASCENDING), ("ts", DESCENDING), ("_id", DESCENDING)], {}),
+    ("usage_logs", [("t", ASCENDING), ("b", ASCENDING), ("ts", DESCENDING), ("_id", DESCENDING)], {}),
+    ("usage_logs", [("t", ASCENDING), ("s", ASCENDING), ("ts", DESCENDING), ("_id", DESCENDING)], {}),
+    ("usage_rollups", [("teacher_id", ASCENDING), ("hour", ASCENDING), ("student_hash", ASCENDING), ("domain", ASCENDING)], {"unique": True}),
+    ("usage_daily", [("teacher_id", ASCENDING), ("day", ASCENDING), ("student_hash", ASCENDING), ("domain", ASCENDING)], {"unique": True}),
+    ("device_time_usage", [("student_hash", ASCENDING), ("device_id", ASCENDING), ("day", ASCENDING), ("domain", ASCENDING)], {"unique": True}),
+    # Time counters are only needed for the current day; keep a few for support
+    ("device_time_usage", [("day", ASCENDING)], {"expireAfterSeconds": TIME_USAGE_RETENTION_DAYS * 86400}),
+    ("usage_sketches", [("scope", ASCENDING), ("scope_id", ASCENDING), ("day", ASCENDING), ("worker", ASCENDING)], {"unique": True}),
+    ("usage_sketches", [("day", ASCENDING)], {"expireAfterSeconds": SKETCH_RETENTION_DAYS * 86400}),
+    ("url_prefixes", [("prefix", ASCENDING)], {"unique": True}),
+]
+
+# Raw events and hourly rollups expire after USAGE_RETENTION_DAYS (0 keeps them
+# forever); daily summaries in usage_daily are kept.
+if USAGE_RETENTION_DAYS > 0:
+    INDEXES += [
+        ("usage_logs", [("ts", ASCENDING)], {"expireAfterSeconds": USAGE_RETENTION_DAYS * 86400}),
+        ("usage_rollups", [("hour", ASCENDING)], {"expireAfterSeconds": USAGE_RETENTION_DAYS * 86400}),
+    ]
+else:
+    INDEXES += [
+        ("usage_logs", [("ts", ASCENDING)], {}),
+        ("usage_rollups", [("hour", ASCENDING)], {}),
+    ]
+
+async def find_index(collection_name: str, keys: list) -> Optional[dict]:
+    async for index in db[collection_name].list_indexes():
+        if list(index["key"].items()) == list(keys):
+            return index
+    return None
+
+async def ensure_indexes() -> List[dict]:
+    # A failing index (e.g. duplicates under a unique key) is reported, not fatal
+    report = []
+    for collection_name, keys, options in INDEXES:
+        entry = {"collection": collection_name, "keys": keys, "unique": options.get("unique", False)}
+        try:
+            entry["name"] = await db[collection_name].create_index(keys, **options)
+            entry["status"] = "ok"
+        except OperationFailure as e:
+            if e.code == 85 and "expireAfterSeconds" in options:
+                # Retention changed: update the existing TTL index in place
+                await db.command({
+                    "collMod": collection_name,
+                    "index": {"keyPattern": dict(keys), "expireAfterSeconds": options["expireAfterSeconds"]}
+                })
+                entry["status"] = "updated"
+                report.append(entry)
+                continue
+            existing = await find_index(collection_name, keys) if e.code == 85 else None
+            if existing is not None and "expireAfterSeconds" in existing and "expireAfterSeconds" not in options:
+                # Retention turned off: collMod cannot remove a TTL, so rebuild the
+                # index without one rather than leave it deleting data
+                logger.warning("Removing the TTL from index %s on %s", existing["name"], collection_name)
+                await db[collection_name].drop_index(existing["name"])
+                entry["name"] = await db[collection_name].create_index(keys, **options)
+                entry["status"] = "updated"
+                report.append(entry)
+                continue
+            logger.error("Could not create index %s on %s: %s", keys, collection_name, e)
+            entry["status"] = "error"
+            entry["error"] = str(e)
+        report.append(entry)
+    return report
+
+def hot_queries() -> List[dict]:
+    # Representative shapes of the queries issued by the request handlers
+    since = datetime.utcnow() - timedelta(days=7)
+    teacher = teacher_key(str(uuid.UUID(int=0)))
+    return [
+        {"name": "teacher_by_email", "collection": "teachers", "filter": {"email": "explain@example.com"}},
+        {"name": "teacher_by_hash_key", "collection": "teachers", "filter": {"hash_key": "XXXXX"}},
+        {"name": "policy_by_teacher", "collection": "policies", "filter": {"teacher_id": "explain"}},
+        {"name": "students_by_teacher", "collection": "students", "filter": {"teacher_id": "explain"}, "sort": [("name", ASCENDING), ("_id", ASCENDING)]},
+        {"name": "students_by_teacher_hash", "collection": "students", "filter": {"teacher_hash": "XXXXX"}},
+        {"name": "recent_usage", "collection": "usage_logs",
+         "filter": {"t": teacher, "ts": {"$gte": since}}, "sort": [("ts", DESCENDING)]},
+        {"name": "usage_log_page", "collection": "usage_logs",
+         "filter": {"t": teacher, **keyset_filter("ts", since, ObjectId(), descending=True)},
+         "sort": [("ts", DESCENDING), ("_id", DESCENDING)]},
+        {"name": "blocked_usage", "collection": "usage_logs",
+         "filter": {"t": teacher, "b": True, "ts": {"$gte": since}}, "sort": [("ts", DESCENDING)]},
+        {"name": "student_activity", "collection": "usage_logs",
+         "filter": {"t": teacher, "s": {"$in": ["XXXXX"]}}, "sort": [("ts", DESCENDING)]},
+        {"name": "url_prefix_by_prefix", "collection": "url_prefixes", "filter": {"prefix": {"$in": ["https://explain.example"]}}},
+        {"name": "usage_rollups_by_teacher", "collection": "usage_rollups",
+         "filter": {"teacher_id": "explain", "hour": {"$gte": since}}},
+    ]
+
+def plan_stages(plan: dict) -> List[dict]:
+    stages = [plan]
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += plan_stages(child)
+    return stages
+
+async def explain_hot_queries() -> List[dict]:
+    report = []
+    for query in hot_queries():
+        cursor = db[query["collection"]].find(query["filter"])
+        if query.get("sort"):
+            cursor = cursor.sort(query["sort"])
+        explanation = await cursor.limit(100).explain()
+        stages = plan_stages(explanation["queryPlanner"]["winningPlan"])
+        report.append({
+            "name": query["name"],
+            "collection": query["collection"],
+            "stages": [stage.get("stage") for stage in stages],
+            "indexes": [stage["indexName"] for stage in stages if "indexName" in stage],
+            "collscan": any(stage.get("stage") == "COLLSCAN" for stage in stages)
+        })
+    return report
+
+# In-Memory Caches
+# Bounded LRU cache whose entries also expire after ttl seconds. Used for the
+# hot extension lookups (hash_key -> teacher, teacher_id -> policy response).
+class TTLCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+teacher_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+unknown_hash_keys = TTLCache(CACHE_MAX_ENTRIES, UNKNOWN_HASH_KEY_CACHE_SECONDS)
+policy_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+token_epochs = TTLCache(CACHE_MAX_ENTRIES, PRINCIPAL_CACHE_TTL_SECONDS)
+
+# Compact usage logs
+# usage_logs documents use short field names and drop empty values:
+#   _id ObjectId, t teacher_id (16-byte UUID), s student_hash, ts timestamp,
+#   b is_blocked, u url prefix id, p rest of the url, n title, d duration
+# The url's scheme://host is replaced by a small integer from the url_prefixes
+# dictionary. Handlers work with the full UsageLog-shaped documents from
+# build_usage_doc; encode_usage_docs/decode_usage_docs convert at the collection.
+# device_id only feeds the time counters and is not stored.
+class UrlPrefixDictionary:
+    # Ids are never reassigned, so both directions are cached without expiry;
+    # least recently used entries are evicted past max_entries
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.ids: "OrderedDict[str, int]" = OrderedDict()
+        self.prefixes: "OrderedDict[int, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.allocated = 0
+
+    def _remember(self, prefix: str, prefix_id: int):
+        for cache, key, value in ((self.ids, prefix, prefix_id), (self.prefixes, prefix_id, prefix)):
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+
+    def _lookup(self, cache: OrderedDict, keys: Iterable) -> tuple:
+        found, missing = {}, []
+        for key in set(keys):
+            if key in cache:
+                cache.move_to_end(key)
+                found[key] = cache[key]
+                self.hits += 1
+            else:
+                missing.append(key)
+                self.misses += 1
+        return found, missing
+
+    async def encode(self, prefixes: Iterable[str]) -> Dict[str, int]:
+        found, missing = self._lookup(self.ids, prefixes)
+        if missing:
+            async for entry in url_prefixes_collection.find({"prefix": {"$in": missing}}):
+                self._remember(entry["prefix"], entry["_id"])
+                found[entry["prefix"]] = entry["_id"]
+            for prefix in missing:
+                if prefix not in found:
+                    found[prefix] = await self._allocate(prefix)
+        return found
+
+    async def _allocate(self, prefix: str) -> int:
+        while True:
+            counter = await maintenance_collection.find_one_and_update(
+                {"_id": "url_prefix_seq"},
+                {"$inc": {"value": 1}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            try:
+                await url_prefixes_collection.insert_one({"_id": counter["value"], "prefix": prefix})
+                self.allocated += 1
+                prefix_id = counter["value"]
+                break
+            except DuplicateKeyError:
+                # Another worker added the prefix first; a taken id just means trying the next one
+                entry = await url_prefixes_collection.find_one({"prefix": prefix})
+                if entry is not None:
+                    prefix_id = entry["_id"]
+                    break
+        self._remember(prefix, prefix_id)
+        return prefix_id
+
+    async def decode(self, prefix_ids: Iterable[int]) -> Dict[int, str]:
+        found, missing = self._lookup(self.prefixes, prefix_ids)
+        if missing:
+            async for entry in url_prefixes_collection.find({"_id": {"$in": missing}}):
+                self._remember(entry["prefix"], entry["_id"])
+                found[entry["_id"]] = entry["prefix"]
+        return found
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.ids),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "allocated": self.allocated
+        }
+
+url_prefixes = UrlPrefixDictionary(CACHE_MAX_ENTRIES)
+
+def teacher_key(teacher_id: str) -> Any:
+    # Teacher ids are UUID strings; stored as 16 bytes instead of 36 characters
+    try:
+        parsed = uuid.UUID(teacher_id)
+    except ValueError:
+        return teacher_id
+    return Binary.from_uuid(parsed) if str(parsed) == teacher_id else teacher_id
+
+def teacher_id_from_key(key: Any) -> str:
+    return str(key.as_uuid()) if isinstance(key, Binary) else key
+
+def split_url(url: str) -> tuple:
+    # (scheme://host, rest), or (None, url) when there is no prefix to share
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return None, url
+    prefix = f"{parts.scheme}://{parts.netloc}"
+    if parts.scheme and parts.netloc and url.startswith(prefix):
+        return prefix, url[len(prefix):]
+    return None, url
+
+async def encode_usage_docs(usage_docs: List[dict]) -> List[dict]:
+    split = [split_url(doc["url"]) for doc in usage_docs]
+    prefix_ids = await url_prefixes.encode(prefix for prefix, _ in split if prefix is not None)
+    encoded = []
+    for doc, (prefix, rest) in zip(usage_docs, split):
+        stored = {
+            "_id": doc["_id"],
+            "t": teacher_key(doc["teacher_id"]),
+            "s": doc["student_hash"],
+            "ts": doc["timestamp"],
+            "b": doc["is_blocked"]
+        }
+        if prefix is not None:
+            stored["u"] = prefix_ids[prefix]
+        if rest:
+            stored["p"] = rest
+        if doc["title"]:
+            stored["n"] = doc["title"]
+        if doc["duration"]:
+            stored["d"] = doc["duration"]
+        encoded.append(stored)
+    return encoded
+
+async def decode_usage_docs(stored_docs: List[dict]) -> List[dict]:
+    prefixes = await url_prefixes.decode(doc["u"] for doc in stored_docs if "u" in doc)
+    decoded = []
+    for stored in stored_docs:
+        if "teacher_id" in stored:
+            # Not migrated yet (manage.py migrate-usage-schema)
+            decoded.append(stored)
+            continue
+        doc = {"_id": stored["_id"]}
+        if "t" in stored:
+            doc["teacher_id"] = teacher_id_from_key(stored["t"])
+        doc["student_hash"] = stored["s"]
+        doc["url"] = prefixes.get(stored["u"], "") + stored.get("p", "") if "u" in stored else stored.get("p", "")
+        doc["title"] = stored.get("n", "")
+        doc["timestamp"] = stored["ts"]
+        doc["duration"] = stored.get("d", 0)
+        doc["is_blocked"] = stored["b"]
+        decoded.append(doc)
+    return decoded
+
+def usage_log_id(value: Any) -> Any:
+    # Keyset cursors carry the ObjectId as a hex string
+    if isinstance(value, str) and ObjectId.is_valid(value):
+        return ObjectId(value)
+    return value
+
+def migrated_usage_id(doc: dict) -> ObjectId:
+    # Deterministic, so re-running an interrupted migration finds the copies it made:
+    # the event time followed by 8 random bytes of the original UUID
+    try:
+        random_bytes = uuid.UUID(str(doc["_id"])).bytes[-8:]
+    except ValueError:
+        return ObjectId()
+    seconds = int(to_naive_utc(doc["timestamp"]).replace(tzinfo=timezone.utc).timestamp()) % 2 ** 32
+    return ObjectId(seconds.to_bytes(4, "big") + random_bytes)
+
+async def migrate_usage_schema(batch_size: int = 1000) -> int:
+    # Rewrites usage_logs documents still in the original format. Copies are
+    # inserted before the originals are deleted, so the run can be interrupted
+    # and repeated; returns the number of documents migrated.
+    migrated = 0
+    while True:
+        legacy = await usage_collection.find({"teacher_id": {"$exists": True}}).limit(batch_size).to_list(batch_size)
+        if not legacy:
+            return migrated
+        encoded = await encode_usage_docs([{**doc, "_id": migrated_usage_id(doc)} for doc in legacy])
+        try:
+            await usage_collection.insert_many(encoded, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        await usage_collection.delete_many({"_id": {"$in": [doc["_id"] for doc in legacy]}})
+        migrated += len(legacy)
+
+async def drop_legacy_usage_indexes() -> List[str]:
+    # Indexes over the original field names no longer serve any query
+    legacy_fields = {"teacher_id", "student_hash", "timestamp", "is_blocked"}
+    dropped = []
+    async for index in usage_collection.list_indexes():
+        if legacy_fields & set(index["key"]):
+            await usage_collection.drop_index(index["name"])
+            dropped.append(index["name"])
+    return dropped
+
+TEACHER_CACHE_PROJECTION = {"_id": 1, "hash_key": 1, "school_name": 1}
+
+async def get_teacher_by_hash(hash_key: str) -> Optional[dict]:
+    teacher = teacher_cache.get(hash_key)
+    if teacher is None:
+        if unknown_hash_keys.get(hash_key):
+            return None
+        teacher = await teachers_collection.find_one({"hash_key": hash_key}, TEACHER_CACHE_PROJECTION)
+        if teacher is not None:
+            teacher_cache.set(hash_key, teacher)
+        else:
+            unknown_hash_keys.set(hash_key, True)
+    return teacher
+
+async def get_teachers_by_hash(hash_keys: List[str]) -> Dict[str, dict]:
+    teachers = {}
+    missing = []
+    for hash_key in hash_keys:
+        teacher = teacher_cache.get(hash_key)
+        if teacher is not None:
+            teachers[hash_key] = teacher
+        elif not unknown_hash_keys.get(hash_key):
+            missing.append(hash_key)
+    
+    if missing:
+        async for teacher in teachers_collection.find({"hash_key": {"$in": missing}}, TEACHER_CACHE_PROJECTION):
+            teacher_cache.set(teacher["hash_key"], teacher)
+            teachers[teacher["hash_key"]] = teacher
+        for hash_key in missing:
+            if hash_key not in teachers:
+                unknown_hash_keys.set(hash_key, True)
+    return teachers
+
+# Cached extension policy: ETag, response payload (as a dict and as ready-to-send
+# JSON bytes) and the compiled domain matcher
+PolicyEntry = namedtuple("PolicyEntry", ["etag", "payload", "body", "matcher"])
+
+async def get_extension_policy_entry(teacher_id: str) -> Optional[PolicyEntry]:
+    # Built once per policy version and served from cache afterwards
+    cached = policy_cache.get(teacher_id)
+    if cached is None:
+        policy = await policies_collection.find_one({"teacher_id": teacher_id})
+        if not policy:
+            return None
+        
+        version = policy.get("version", 0)
+        matcher = DomainMatcher(policy.get("blocked_sites", []), policy.get("controlled_sites", []))
+        payload = {
+            "blocked_sites": policy.get("blocked_sites", []),
+            "allowed_sites": policy.get("allowed_sites", {}),
+            "controlled_sites": policy.get("controlled_sites", []),
+            "daily_time_limit": policy.get("daily_time_limit", 3600),
+            "version": version,
+            "matcher": matcher.to_payload()
+        }
+        cached = PolicyEntry(policy_etag(teacher_id, version), payload, dump_json(payload), matcher)
+        policy_cache.set(teacher_id, cached)
+    return cached
+
+# Policy Change Hub
+# Fans policy-changed messages out to every open extension stream of a teacher
+# (and token revocations out to every worker's auth cache).
+# Without REDIS_URL the hub is in-process; with it, messages go through a Redis
+# (or Redis-compatible) channel so every uvicorn worker sees them and also drops
+# its cached copy of the policy.
+class PolicyHub:
+    CHANNEL = "butterfly:policy-changes"
+
+    def __init__(self, redis_url: Optional[str] = None):
+        self.redis_url = redis_url
+        self._subscribers: Dict[str, set] = {}
+        self._redis = None
+        self._listener: Optional[asyncio.Task] = None
+        self.published_messages = 0
+        self.delivered_messages = 0
+
+    async def start(self):
+        if not self.redis_url:
+            return
+        if aioredis is None:
+            logger.warning("REDIS_URL is set but the redis package is not installed; using in-process policy hub")
+            return
+        self._redis = aioredis.from_url(self.redis_url)
+        pubsub = self._redis.pubsub()
+        await pubsub.subscribe(self.CHANNEL)
+        self._listener = asyncio.create_task(self._listen(pubsub))
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            self._listener = None
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+    def subscribe(self, teacher_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(teacher_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, teacher_id: str, queue: asyncio.Queue):
+        queues = self._subscribers.get(teacher_id)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[teacher_id]
+
+    async def publish(self, teacher_id: str, message: dict):
+        self.published_messages += 1
+        if self._redis is not None:
+            await self._redis.publish(self.CHANNEL, json.dumps({"teacher_id": teacher_id, "message": message}))
+        else:
+            self._deliver(teacher_id, message)
+
+    async def _listen(self, pubsub):
+        while True:
+            try:
+                async for item in pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    data = json.loads(item["data"])
+                    self._deliver(data["teacher_id"], data["message"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Policy hub listener failed; resubscribing")
+                await asyncio.sleep(1)
+
+    def _deliver(self, teacher_id: str, message: dict):
+        if message.get("type") == "tokens_revoked":
+            # Not for extensions: only this worker's auth cache needs to know
+            token_epochs.set(teacher_id, message["epoch"])
+            return
+        policy_cache.invalidate(teacher_id)
+        for queue in self._subscribers.get(teacher_id, ()):
+            # A pending message already tells the client to refetch, so keep the newest one
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+            self.delivered_messages += 1
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis" if self._redis is not None else "in-process",
+            "teachers": len(self._subscribers),
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+            "published_messages": self.published_messages,
+            "delivered_messages": self.delivered_messages
+        }
+
+policy_hub = PolicyHub(REDIS_URL)
+
+# Usage Write-Behind Buffer
+# Usage documents are queued in memory and written to Mongo in batches, either
+# when a batch reaches batch_size documents or once flush_interval seconds have
+# passed. The queue is bounded: submit() returns False instead of blocking.
+class UsageWriteBuffer:
+    FLUSH_RETRIES = 3
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.accepted_events = 0
+        self.flushed_events = 0
+        self.dropped_events = 0
+        self.failed_events = 0
+        self.flush_count = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+        self.last_flush_seconds = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Stop accepting new events and wait until everything queued is written
+        if self._task is None:
+            return
+        self._closing = True
+        await self._task
+        self._task = None
+
+    def submit(self, usage_doc: dict) -> bool:
+        if not self.running:
+            return False
+        try:
+            self.queue.put_nowait(usage_doc)
+        except asyncio.QueueFull:
+            self.dropped_events += 1
+            return False
+        self.accepted_events += 1
+        return True
+
+    async def _run(self):
+        while not (self._closing and self.queue.empty()):
+            batch = await self._collect()
+            if batch:
+                await self._flush(batch)
+
+    async def _collect(self) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _flush(self, batch: List[dict]):
+        started = time.perf_counter()
+        written = batch
+        for attempt in range(self.FLUSH_RETRIES):
+            try:
+                await usage_collection.insert_many(await encode_usage_docs(batch), ordered=False)
+                written = batch
+                break
+            except BulkWriteError as e:
+                # Duplicate keys mean a previous attempt already wrote the document
+                failed = {
+                    error["index"] for error in e.details.get("writeErrors", [])
+                    if error.get("code") != 11000
+                }
+                written = [doc for index, doc in enumerate(batch) if index not in failed]
+                break
+            except Exception:
+                logger.exception("Usage flush attempt %d failed", attempt + 1)
+                written = []
+                await asyncio.sleep(0.1 * 2 ** attempt)
+        
+        await record_usage_side_effects(written)
+        
+        elapsed = time.perf_counter() - started
+        self.flush_count += 1
+        self.flushed_events += len(written)
+        self.failed_events += len(batch) - len(written)
+        self.last_flush_seconds = elapsed
+        self.flush_seconds_total += elapsed
+        self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_capacity": self.max_size,
+            "accepted_events": self.accepted_events,
+            "flushed_events": self.flushed_events,
+            "dropped_events": self.dropped_events,
+            "failed_events": self.failed_events,
+            "flush_count": self.flush_count,
+            "flush_latency_ms": {
+                "last": round(self.last_flush_seconds * 1000, 2),
+                "avg": round(self.flush_seconds_total / self.flush_count * 1000, 2) if self.flush_count else 0.0,
+                "max": round(self.flush_seconds_max * 1000, 2)
+            }
+        }
+
+usage_buffer = UsageWriteBuffer(
+    max_size=USAGE_QUEUE_MAX_SIZE,
+    batch_size=USAGE_FLUSH_BATCH_SIZE,
+    flush_interval=USAGE_FLUSH_INTERVAL_MS / 1000
+)
+
+# Daily Time Counters
+# Seconds spent per (class hash key, device, UTC day, controlled rule). Events
+# without a device_id (older extensions) are not counted: the hash key alone
+# would add up every device in the class.
+# Recorded usage is added to in-memory counters that are flushed as $inc upserts
+# every flush_interval. Reads combine a short-lived cache of the stored totals
+# with this worker's not-yet-written increments, so a budget check costs a dict
+# lookup; other workers' time shows up once they flush and the cache expires.
+class TimeCounterStore:
+    def __init__(self, flush_interval: float, cache_ttl: float):
+        self.flush_interval = flush_interval
+        self.pending: Dict[tuple, Dict[str, int]] = {}  # (student_hash, device_id, day) -> {domain: seconds}
+        self.in_flight: Dict[tuple, Dict[str, int]] = {}
+        self.totals = TTLCache(CACHE_MAX_ENTRIES, cache_ttl)
+        self._task: Optional[asyncio.Task] = None
+        self.flush_count = 0
+        self.flushed_counters = 0
+        self.failed_flushes = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def record(self, usage_docs: List[dict]):
+        for doc in usage_docs:
+            if doc["is_blocked"] or doc["duration"] <= 0 or not doc.get("device_id"):
+                continue
+            entry = await get_extension_policy_entry(doc["teacher_id"])
+            domain = entry.matcher.match_controlled(doc["url"]) if entry else None
+            if domain:
+                counters = self.pending.setdefault((doc["student_hash"], doc["device_id"], usage_day(doc["timestamp"])), {})
+                counters[domain] = counters.get(domain, 0) + doc["duration"]
+
+    async def used(self, student_hash: str, device_id: str, day: datetime) -> Dict[str, int]:
+        key = (student_hash, device_id, day)
+        totals = self.totals.get(key)
+        if totals is None:
+            docs = await time_usage_collection.find(
+                {"student_hash": student_hash, "device_id": device_id, "day": day},
+                {"domain": 1, "seconds": 1}
+            ).to_list(None)
+            totals = {doc["domain"]: doc["seconds"] for doc in docs}
+            self.totals.set(key, totals)
+        used = dict(totals)
+        for unwritten in (self.in_flight.get(key), self.pending.get(key)):
+            for domain, seconds in (unwritten or {}).items():
+                used[domain] = used.get(domain, 0) + seconds
+        return used
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending or self.in_flight:
+            return
+        self.in_flight, self.pending = self.pending, {}
+        try:
+            await time_usage_collection.bulk_write([
+                UpdateOne(
+                    {"student_hash": student_hash, "device_id": device_id, "day": day, "domain": domain},
+                    {"$inc": {"seconds": seconds}},
+                    upsert=True
+                )
+                for (student_hash, device_id, day), counters in self.in_flight.items()
+                for domain, seconds in counters.items()
+            ], ordered=False)
+        except Exception:
+            logger.exception("Failed to flush time counters")
+            self.failed_flushes += 1
+            # Put the increments back so the next flush retries them
+            for key, counters in self.in_flight.items():
+                pending = self.pending.setdefault(key, {})
+                for domain, seconds in counters.items():
+                    pending[domain] = pending.get(domain, 0) + seconds
+        else:
+            self.flush_count += 1
+            for key, counters in self.in_flight.items():
+                self.flushed_counters += len(counters)
+                # Keep cached totals in step with what this worker just wrote
+                totals = self.totals.get(key)
+                if totals is not None:
+                    for domain, seconds in counters.items():
+                        totals[domain] = totals.get(domain, 0) + seconds
+        finally:
+            self.in_flight = {}
+
+    def stats(self) -> dict:
+        return {
+            "pending_counters": sum(len(counters) for counters in self.pending.values()),
+            "flush_count": self.flush_count,
+            "flushed_counters": self.flushed_counters,
+            "failed_flushes": self.failed_flushes,
+            "cache": self.totals.stats()
+        }
+
+time_counters = TimeCounterStore(flush_interval=TIME_COUNTER_FLUSH_SECONDS, cache_ttl=TIME_BUDGET_CACHE_SECONDS)
+
+# Usage Sketches
+# Approximate answers over large windows without scanning usage_logs: per day
+# and per scope (teacher, school, all) each worker keeps a TopK of domains and
+# HyperLogLogs of distinct devices (all / with a blocked attempt). Every
+# worker periodically writes its own cumulative sketches to usage_sketches, one
+# document per (scope, scope_id, day, worker); queries merge the documents in
+# the window, using this worker's in-memory sketches in place of its own rows.
+#
+# Only today's sketches stay in memory (about 6 KB each). A late event for an
+# earlier day starts an empty sketch, which is merged with this worker's stored
+# document for that day before it is written back.
+class SketchStore:
+    KINDS = ("domains", "devices", "blocked_devices")
+    CMS_WIDTH = 256  # Frequencies within ~1% of the day's events
+    HLL_PRECISION = 10  # Distinct counts within ~3%
+
+    def __init__(self, flush_interval: float, cache_ttl: float, cache_entries: int):
+        self.flush_interval = flush_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.sketches: Dict[tuple, dict] = {}  # (scope, scope_id, day) -> {kind: sketch}
+        self.dirty = set()
+        self.unmerged = set()  # In memory, but not yet combined with the stored document
+        self.results = TTLCache(cache_entries, cache_ttl)
+        self._task: Optional[asyncio.Task] = None
+        self.recorded_events = 0
+        self.flush_count = 0
+
+    @classmethod
+    def empty(cls) -> dict:
+        return {
+            "domains": TopK(sketch=CountMinSketch(width=cls.CMS_WIDTH)),
+            "devices": HyperLogLog(cls.HLL_PRECISION),
+            "blocked_devices": HyperLogLog(cls.HLL_PRECISION)
+        }
+
+    @staticmethod
+    def merge_into(target: dict, source: dict):
+        for kind in SketchStore.KINDS:
+            target[kind].merge(source[kind])
+
+    @staticmethod
+    def merge_stored(target: dict, doc: dict):
+        # Documents written with other dimensions (or kinds) cannot be merged; skip them
+        loaders = {"domains": TopK.from_bytes, "devices": HyperLogLog.from_bytes, "blocked_devices": HyperLogLog.from_bytes}
+        for kind, load in loaders.items():
+            try:
+                target[kind].merge(load(doc[kind]))
+            except (KeyError, ValueError):
+                logger.debug("Skipping incompatible %s sketch for %s/%s", kind, doc.get("scope"), doc.get("scope_id"))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def record(self, usage_docs: List[dict]):
+        today = usage_day(datetime.utcnow())
+        for doc in usage_docs:
+            teacher = await get_teacher_by_hash(doc["student_hash"])
+            day = usage_day(doc["timestamp"])
+            domain = normalize_host(doc["url"])
+            device_id = doc.get("device_id")
+            scopes = [("teacher", doc["teacher_id"]), ("all", "all")]
+            if teacher and teacher.get("school_name"):
+                scopes.append(("school", teacher["school_name"]))
+            for scope, scope_id in scopes:
+                key = (scope, scope_id, day)
+                sketch = self.sketches.get(key)
+                if sketch is None:
+                    sketch = self.sketches[key] = self.empty()
+                    if day < today:
+                        self.unmerged.add(key)
+                if domain:
+                    sketch["domains"].add(domain)
+                if device_id:
+                    sketch["devices"].add(device_id)
+                    if doc["is_blocked"]:
+                        sketch["blocked_devices"].add(device_id)
+                self.dirty.add(key)
+            self.recorded_events += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to persist usage sketches")
+
+    async def _merge_unmerged(self, keys: set):
+        # Fold this worker's stored documents into sketches rebuilt after eviction
+        docs = await sketches_collection.find({
+            "worker": self.worker_id,
+            "$or": [{"scope": scope, "scope_id": scope_id, "day": day} for scope, scope_id, day in keys]
+        }).to_list(None)
+        for doc in docs:
+            self.merge_stored(self.sketches[(doc["scope"], doc["scope_id"], doc["day"])], doc)
+        self.unmerged -= keys
+
+    async def flush(self):
+        if self.dirty:
+            keys, self.dirty = self.dirty, set()
+            try:
+                if keys & self.unmerged:
+                    await self._merge_unmerged(keys & self.unmerged)
+                await sketches_collection.bulk_write([
+                    UpdateOne(
+                        {"scope": scope, "scope_id": scope_id, "day": day, "worker": self.worker_id},
+                        {"$set": {kind: self.sketches[(scope, scope_id, day)][kind].to_bytes() for kind in self.KINDS}},
+                        upsert=True
+                    )
+                    for scope, scope_id, day in keys
+                ], ordered=False)
+            except Exception:
+                self.dirty |= keys
+                raise
+            self.flush_count += 1
+        # Earlier days are persisted; late events for them are merged on the next flush
+        today = usage_day(datetime.utcnow())
+        for key in [key for key in self.sketches if key[2] < today and key not in self.dirty]:
+            del self.sketches[key]
+
+    async def query(self, scope: str, scope_id: str, days: int) -> dict:
+        cache_key = (scope, scope_id, days)
+        merged = self.results.get(cache_key)
+        if merged is not None:
+            return merged
+        
+        since = usage_day(datetime.utcnow()) - timedelta(days=days - 1)
+        merged = self.empty()
+        async for doc in sketches_collection.find({"scope": scope, "scope_id": scope_id, "day": {"$gte": since}}):
+            key = (scope, scope_id, doc["day"])
+            if doc["worker"] == self.worker_id and key in self.sketches and key not in self.unmerged:
+                continue
+            self.merge_stored(merged, doc)
+        for (key_scope, key_id, day), sketch in self.sketches.items():
+            if key_scope == scope and key_id == scope_id and day >= since:
+                self.merge_into(merged, sketch)
+        self.results.set(cache_key, merged)
+        return merged
+
+    def stats(self) -> dict:
+        return {
+            "in_memory_sketches": len(self.sketches),
+            "dirty_sketches": len(self.dirty),
+            "recorded_events": self.recorded_events,
+            "flush_count": self.flush_count,
+            "query_cache": self.results.stats()
+        }
+
+sketch_store = SketchStore(
+    flush_interval=SKETCH_FLUSH_SECONDS,
+    cache_ttl=SKETCH_QUERY_CACHE_SECONDS,
+    cache_entries=SKETCH_QUERY_CACHE_MAX_ENTRIES
+)
+
+def sketch_summary(sketch: dict, days: int, top: int) -> dict:
+    # Devices, not students: usage events only identify the class hash key and the device
+    return {
+        "days": days,
+        "approximate": True,
+        "total_events": sketch["domains"].total,
+        "top_domains": [{"domain": domain, "count": count} for domain, count in sketch["domains"].top(top)],
+        "distinct_devices": sketch["devices"].count(),
+        "distinct_blocked_devices": sketch["blocked_devices"].count()
+    }
+
+# Rate Limiting & Load Shedding
+# Extension endpoints are only guarded by a short hash key, so every hash key and
+# client IP gets a token bucket and excess requests are answered with a 429
+# before any Mongo work. Behind a reverse proxy run uvicorn with --proxy-headers
+# so request.client is the real client address.
+class TokenBucketLimiter:
+    def __init__(self, rate: float, burst: float, max_keys: int, new_key_rate: float = 0, new_key_burst: float = 0):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, last refill]
+        # Keys without a bucket draw from one shared bucket first (a rate of 0 disables it)
+        self.new_key_rate = new_key_rate
+        self.new_key_burst = new_key_burst
+        self._new_keys = [new_key_burst, time.monotonic()]
+        self.allowed = 0
+        self.limited = 0
+        self.new_keys_limited = 0
+
+    @staticmethod
+    def _take(bucket: list, rate: float, burst: float, now: float) -> float:
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+    def acquire(self, key: str) -> float:
+        # 0 when the request may proceed, otherwise seconds until a token is available
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if self.new_key_rate > 0:
+                wait = self._take(self._new_keys, self.new_key_rate, self.new_key_burst, now)
+                if wait > 0:
+                    self.limited += 1
+                    self.new_keys_limited += 1
+                    return wait
+            bucket = self._buckets[key] = [self.burst, now]
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        wait = self._take(bucket, self.rate, self.burst, now)
+        if wait > 0:
+            self.limited += 1
+        else:
+            self.allowed += 1
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "rate_per_second": self.rate,
+            "burst": self.burst,
+            "keys": len(self._buckets),
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "new_keys_limited": self.new_keys_limited
+        }
+
+class LoadShedder:
+    # Tracks requests in flight on this worker. When the database slows down they
+    # pile up; extension requests are then refused with a 503, usage writes first,
+    # so dashboard requests (never shed) keep getting served.
+    EXEMPT_PATHS = {"/api/extension/policy/stream", "/metrics"}  # long-lived or trivial
+
+    def __init__(self, max_in_flight: int, low_priority_fraction: float):
+        self.max_in_flight = max_in_flight
+        self.low_priority_fraction = low_priority_fraction
+        self.in_flight = 0
+        self.shed = {"usage": 0, "policy": 0}
+
+    def admit(self, priority: str, backlogged: bool = False) -> bool:
+        if self.max_in_flight <= 0:
+            return True
+        limit = self.max_in_flight * (self.low_priority_fraction if priority == "usage" else 1)
+        if self.in_flight > limit or backlogged:
+            self.shed[priority] += 1
+            return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "shed": dict(self.shed)
+        }
+
+class InFlightMiddleware:
+    def __init__(self, app, shedder: LoadShedder):
+        self.app = app
+        self.shedder = shedder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.shedder.EXEMPT_PATHS:
+            await self.app(scope, receive, send)
+            return
+        self.shedder.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.shedder.in_flight -= 1
+
+hash_key_limiter = TokenBucketLimiter(
+    EXTENSION_RATE_PER_HASH_KEY, EXTENSION_BURST_PER_HASH_KEY, RATE_LIMIT_MAX_KEYS,
+    EXTENSION_NEW_HASH_KEYS_PER_SECOND, EXTENSION_NEW_HASH_KEYS_BURST
+)
+ip_limiter = TokenBucketLimiter(EXTENSION_RATE_PER_IP, EXTENSION_BURST_PER_IP, RATE_LIMIT_MAX_KEYS)
+load_shedder = LoadShedder(MAX_IN_FLIGHT_REQUESTS, LOW_PRIORITY_SHED_FRACTION)
+app.add_middleware(InFlightMiddleware, shedder=load_shedder)
+
+def guard_extension_request(http_request: Request, hash_keys: Iterable[str], priority: str = "policy"):
+    # Cheap checks that run before an extension request touches Mongo
+    client_ip = http_request.client.host if http_request.client else "unknown"
+    retry_after = max([ip_limiter.acquire(client_ip)] + [hash_key_limiter.acquire(hash_key) for hash_key in hash_keys])
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(retry_after))}
         )
+    
+    backlogged = (
+        priority == "usage" and usage_buffer.queue is not None
+        and usage_buffer.queue.qsize() >= usage_buffer.max_size * LOW_PRIORITY_SHED_FRACTION
+    )
+    if not load_shedder.admit(priority, backlogged):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy, retry later",
+            headers={"Retry-After": "1"}
+        )
+
+@app.on_event("startup")
+async def connect_database():
+    if client is None:
+        init_database(create_mongo_client())
+
+@app.on_event("startup")
+async def provision_indexes():
+    await ensure_indexes()
+
+usage_compactor_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_usage_compactor():
+    global usage_compactor_task
+    usage_compactor_task = asyncio.create_task(run_usage_compactor())
+
+@app.on_event("shutdown")
+async def stop_usage_compactor():
+    if usage_compactor_task is not None:
+        usage_compactor_task.cancel()
+
+@app.on_event("startup")
+async def start_usage_buffer():
+    usage_buffer.start()
+
+@app.on_event("shutdown")
+async def drain_usage_buffer():
+    await usage_buffer.stop()
+
+@app.on_event("startup")
+async def start_time_counters():
+    time_counters.start()
+
+@app.on_event("shutdown")
+async def flush_time_counters():
+    # After the usage buffer drain, so its last events are counted
+    await time_counters.stop()
+
+@app.on_event("startup")
+async def start_sketch_store():
+    sketch_store.start()
+
+@app.on_event("shutdown")
+async def flush_sketch_store():
+    await sketch_store.stop()
+
+@app.on_event("shutdown")
+async def stop_password_hasher():
+    password_hasher.shutdown()
+
+@app.on_event("startup")
+async def start_policy_hub():
+    await policy_hub.start()
+
+@app.on_event("shutdown")
+async def stop_policy_hub():
+    await policy_hub.stop()
+
+@app.on_event("shutdown")
+async def close_database():
+    # Registered last so the usage buffer has drained before the pool closes
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+metrics.register_stats({
+    "usage_buffer": lambda: usage_buffer.stats(),
+    "teacher_cache": lambda: teacher_cache.stats(),
+    "unknown_hash_keys": lambda: unknown_hash_keys.stats(),
+    "policy_cache": lambda: policy_cache.stats(),
+    "token_epochs": lambda: token_epochs.stats(),
+    "policy_hub": lambda: policy_hub.stats(),
+    "password_hasher": lambda: password_hasher.stats(),
+    "time_counters": lambda: time_counters.stats(),
+    "hash_key_limiter": lambda: hash_key_limiter.stats(),
+    "ip_limiter": lambda: ip_limiter.stats(),
+    "load_shedder": lambda: load_shedder.stats(),
+    "sketch_store": lambda: sketch_store.stats(),
+    "url_prefixes": lambda: url_prefixes.stats()
+})
 
 # API Routes
 
@@ -124,6 +1856,28 @@ async def get_current_teacher(credentials: HTTPAuthorizationCredentials = Depend
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.utcnow()}
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return Response(metrics.render_latest(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/api/health/metrics")
+async def health_metrics():
+    return {
+        "usage_buffer": usage_buffer.stats(),
+        "teacher_cache": teacher_cache.stats(),
+        "unknown_hash_keys": unknown_hash_keys.stats(),
+        "policy_cache": policy_cache.stats(),
+        "token_epochs": token_epochs.stats(),
+        "policy_hub": policy_hub.stats(),
+        "password_hasher": password_hasher.stats(),
+        "time_counters": time_counters.stats(),
+        "hash_key_limiter": hash_key_limiter.stats(),
+        "ip_limiter": ip_limiter.stats(),
+        "load_shedder": load_shedder.stats(),
+        "sketch_store": sketch_store.stats(),
+        "url_prefixes": url_prefixes.stats()
+    }
+
 # Teacher Authentication
 @app.post("/api/teachers/register")
 async def register_teacher(teacher: TeacherCreate):
@@ -139,14 +1893,25 @@ async def register_teacher(teacher: TeacherCreate):
     teacher_doc = {
         "_id": teacher_id,
         "email": teacher.email,
-        "password": hash_password(teacher.password),
+        "password": await password_hasher.hash(teacher.password),
         "name": teacher.name,
         "school_name": teacher.school_name,
         "hash_key": hash_key,
         "created_at": datetime.utcnow()
     }
     
-    await teachers_collection.insert_one(teacher_doc)
+    # hash_key and email are unique indexes; retry on a hash key collision
+    for attempt in range(5):
+        try:
+            await teachers_collection.insert_one(teacher_doc)
+            unknown_hash_keys.invalidate(hash_key)
+            break
+        except DuplicateKeyError as e:
+            if "email" in str(e):
+                raise HTTPException(status_code=400, detail="Teacher already registered")
+            hash_key = teacher_doc["hash_key"] = generate_hash_key()
+    else:
+        raise HTTPException(status_code=500, detail="Could not allocate a unique hash key")
     
     # Create default policy
     policy_doc = {
@@ -160,6 +1925,7 @@ async def register_teacher(teacher: TeacherCreate):
         },
         "controlled_sites": ["facebook.com", "twitter.com", "youtube.com"],
         "daily_time_limit": 3600,
+        "version": 1,
         "created_at": datetime.utcnow()
     }
     
@@ -174,16 +1940,14 @@ async def register_teacher(teacher: TeacherCreate):
 @app.post("/api/teachers/login")
 async def login_teacher(teacher: TeacherLogin):
     teacher_doc = await teachers_collection.find_one({"email": teacher.email})
-    if not teacher_doc or not verify_password(teacher.password, teacher_doc["password"]):
+    if not teacher_doc or not await password_hasher.verify(teacher.password, teacher_doc["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password"
         )
     
     access_token_expires = timedelta(minutes=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30)))
-    access_token = create_access_token(
-        data={"sub": teacher_doc["_id"]}, expires_delta=access_token_expires
-    )
+    access_token = create_teacher_token(teacher_doc, expires_delta=access_token_expires)
     
     return {
         "access_token": access_token,
@@ -197,14 +1961,28 @@ async def login_teacher(teacher: TeacherLogin):
         }
     }
 
+@app.post("/api/teachers/logout-all")
+async def logout_all_sessions(current_teacher: dict = Depends(get_current_teacher)):
+    # Bumping the epoch revokes every token issued so far
+    teacher = await teachers_collection.find_one_and_update(
+        {"_id": current_teacher["_id"]},
+        {"$inc": {"token_epoch": 1}},
+        projection={"token_epoch": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    token_epochs.set(current_teacher["_id"], teacher["token_epoch"])
+    await policy_hub.publish(current_teacher["_id"], {
+        "type": "tokens_revoked",
+        "epoch": teacher["token_epoch"]
+    })
+    return {"message": "All sessions revoked"}
+
 # Student Management
-@app.post("/api/students")
-async def create_student(student: StudentCreate, current_teacher: dict = Depends(get_current_teacher)):
-    student_id = str(uuid.uuid4())
-    student_doc = {
-        "_id": student_id,
-        "teacher_id": current_teacher["_id"],
-        "teacher_hash": current_teacher["hash_key"],
+def build_student_doc(student: StudentCreate, teacher: dict) -> dict:
+    return {
+        "_id": str(uuid.uuid4()),
+        "teacher_id": teacher["_id"],
+        "teacher_hash": teacher["hash_key"],
         "name": student.name,
         "student_id": student.student_id,
         "class_name": student.class_name,
@@ -212,14 +1990,249 @@ async def create_student(student: StudentCreate, current_teacher: dict = Depends
         "created_at": datetime.utcnow(),
         "last_active": None
     }
-    
-    await students_collection.insert_one(student_doc)
+
+@app.post("/api/students")
+async def create_student(student: StudentCreate, current_teacher: dict = Depends(get_current_teacher)):
+    student_doc = build_student_doc(student, current_teacher)
+    try:
+        await students_collection.insert_one(student_doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Student ID already exists")
     return {"message": "Student created successfully", "student": student_doc}
 
+# Roster Import
+class LineSplitter:
+    # Splits text that arrives in chunks into lines. Only the unfinished line
+    # is kept, as a list of pieces; a line longer than max_length is dropped as
+    # it arrives and comes out as None.
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.parts = []
+        self.length = 0
+        self.too_long = False
+
+    def feed(self, text: str) -> List[Optional[str]]:
+        lines = []
+        start = 0
+        while True:
+            end = text.find("\n", start)
+            piece = text[start:] if end < 0 else text[start:end]
+            if not self.too_long:
+                self.length += len(piece)
+                self.too_long = self.length > self.max_length
+                if self.too_long:
+                    self.parts.clear()
+                else:
+                    self.parts.append(piece)
+            if end < 0:
+                return lines
+            lines.append(self.finish())
+            start = end + 1
+
+    def pending(self) -> bool:
+        return self.length > 0 or self.too_long
+
+    def finish(self) -> Optional[str]:
+        line = None if self.too_long else "".join(self.parts).rstrip("\r")
+        self.parts, self.length, self.too_long = [], 0, False
+        return line
+
+async def iter_body_lines(request: Request):
+    # Decodes the request body as it arrives and yields complete lines, or None
+    # for a line longer than IMPORT_MAX_LINE_LENGTH
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    splitter = LineSplitter(IMPORT_MAX_LINE_LENGTH)
+    try:
+        async for chunk in request.stream():
+            for line in splitter.feed(decoder.decode(chunk)):
+                yield line
+        lines = splitter.feed(decoder.decode(b"", final=True))
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Roster must be UTF-8 encoded")
+    for line in lines:
+        yield line
+    if splitter.pending():
+        yield splitter.finish()
+
+class CsvLineFeed:
+    # Input for a csv.reader that iter_csv_records tops up from the request
+    # stream. Running dry before the end of the body means a quoted field
+    # spans more lines than were buffered.
+    def __init__(self):
+        self.lines = deque()
+        self.eof = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self.lines:
+            line = self.lines.popleft()
+            if line is None:
+                raise csv.Error(f"Line is longer than {IMPORT_MAX_LINE_LENGTH} characters")
+            return line
+        if self.eof:
+            raise StopIteration
+        raise csv.Error(f"Quoted field spans more than {CSV_MAX_RECORD_LINES} lines")
+
+async def iter_csv_records(lines):
+    # Yields (record, error) per data row. One csv.reader parses the whole body,
+    # so quoted fields may span lines and a stray quote inside an unquoted field
+    # stays literal; before each record the feed holds up to CSV_MAX_RECORD_LINES.
+    feed = CsvLineFeed()
+    reader = csv.reader(feed)
+    header = None
+    while True:
+        while not feed.eof and len(feed.lines) < CSV_MAX_RECORD_LINES:
+            try:
+                line = await lines.__anext__()
+                feed.lines.append(None if line is None else line + "\n")
+            except StopAsyncIteration:
+                feed.eof = True
+        try:
+            values = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield None, str(e)
+            return
+        if not any(value.strip() for value in values):
+            continue
+        if header is None:
+            header = [column.strip() for column in values]
+            missing = [field for field in StudentCreate.model_fields if field not in header]
+            if missing:
+                raise HTTPException(status_code=400, detail=f"CSV header is missing: {', '.join(missing)}")
+            continue
+        yield dict(zip(header, values)), None
+
+async def iter_ndjson_records(lines):
+    async for line in lines:
+        if line is None:
+            yield None, f"Line is longer than {IMPORT_MAX_LINE_LENGTH} characters"
+            continue
+        if not line.strip():
+            continue
+        try:
+            record = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            yield None, "Invalid JSON"
+            continue
+        yield (record, None) if isinstance(record, dict) else (None, "Expected a JSON object")
+
+def add_import_error(report: dict, row: int, student_id: Optional[str], error: str):
+    report["error_count"] += 1
+    if len(report["errors"]) < IMPORT_MAX_ERRORS:
+        report["errors"].append({"row": row, "student_id": student_id, "error": error})
+
+async def import_student_chunk(chunk: List[tuple], teacher: dict, dry_run: bool, update_existing: bool, report: dict):
+    if dry_run:
+        existing = await students_collection.find(
+            {"teacher_id": teacher["_id"], "student_id": {"$in": [student.student_id for _, student in chunk]}},
+            {"student_id": 1}
+        ).to_list(None)
+        existing = {doc["student_id"] for doc in existing}
+        for row, student in chunk:
+            if student.student_id not in existing:
+                report["inserted"] += 1
+            elif update_existing:
+                report["updated"] += 1
+            else:
+                add_import_error(report, row, student.student_id, "Student ID already exists")
+        return
+
+    try:
+        if update_existing:
+            result = await students_collection.bulk_write([
+                UpdateOne(
+                    {"teacher_id": teacher["_id"], "student_id": student.student_id},
+                    {
+                        "$set": {"name": student.name, "class_name": student.class_name, "grade": student.grade},
+                        "$setOnInsert": {
+                            "_id": str(uuid.uuid4()),
+                            "teacher_hash": teacher["hash_key"],
+                            "created_at": datetime.utcnow(),
+                            "last_active": None
+                        }
+                    },
+                    upsert=True
+                )
+                for _, student in chunk
+            ], ordered=False)
+            report["inserted"] += result.upserted_count
+            report["updated"] += result.matched_count
+        else:
+            await students_collection.insert_many([build_student_doc(student, teacher) for _, student in chunk], ordered=False)
+            report["inserted"] += len(chunk)
+    except BulkWriteError as e:
+        report["inserted"] += e.details.get("nInserted", 0) + e.details.get("nUpserted", 0)
+        report["updated"] += e.details.get("nMatched", 0)
+        for error in e.details.get("writeErrors", []):
+            row, student = chunk[error["index"]]
+            message = "Student ID already exists" if error.get("code") == 11000 else error.get("errmsg", "Write failed")
+            add_import_error(report, row, student.student_id, message)
+
+@app.post("/api/students/import")
+async def import_students(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    dry_run: bool = False,
+    update_existing: bool = False,
+    current_teacher: dict = Depends(get_current_teacher)
+):
+    # Streams a CSV (header: name,student_id,class_name,grade) or NDJSON roster.
+    # Rows are validated one by one and written in unordered chunks; existing
+    # student IDs are reported as errors unless update_existing is set.
+    import_format = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    lines = iter_body_lines(request)
+    records = iter_csv_records(lines) if import_format == "csv" else iter_ndjson_records(lines)
+    
+    report = {"dry_run": dry_run, "rows": 0, "inserted": 0, "updated": 0, "error_count": 0, "errors": []}
+    seen = set()
+    chunk = []
+    async for record, error in records:
+        report["rows"] += 1
+        row = report["rows"]
+        student = None
+        if error is None:
+            try:
+                student = StudentCreate(**{
+                    field: value.strip() if isinstance(value, str) else value
+                    for field, value in record.items() if field in StudentCreate.model_fields
+                })
+            except ValidationError as e:
+                error = "; ".join(f"{'.'.join(map(str, detail['loc']))}: {detail['msg']}" for detail in e.errors())
+        if student is not None and student.student_id in seen:
+            error = "Duplicate student_id in file"
+        if error is not None:
+            add_import_error(report, row, (record or {}).get("student_id"), error)
+            continue
+        
+        seen.add(student.student_id)
+        chunk.append((row, student))
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            await import_student_chunk(chunk, current_teacher, dry_run, update_existing, report)
+            chunk = []
+    if chunk:
+        await import_student_chunk(chunk, current_teacher, dry_run, update_existing, report)
+    
+    return report
+
+async def get_student_page(teacher_id: str, limit: int, cursor: Optional[str]) -> List[dict]:
+    # Students ordered by (name, _id); each page is one index range scan
+    query = {"teacher_id": teacher_id}
+    if cursor:
+        query.update(keyset_filter("name", *decode_cursor(cursor)))
+    return await students_collection.find(query).sort([("name", ASCENDING), ("_id", ASCENDING)]).limit(limit).to_list(limit)
+
 @app.get("/api/students")
-async def get_students(current_teacher: dict = Depends(get_current_teacher)):
-    students = await students_collection.find({"teacher_id": current_teacher["_id"]}).to_list(100)
-    return {"students": students}
+async def get_students(
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_teacher: dict = Depends(get_current_teacher)
+):
+    students = await get_student_page(current_teacher["_id"], limit, cursor)
+    return FastJSONResponse({"students": students, "next_cursor": next_cursor(students, "name", limit)})
 
 @app.get("/api/students/{student_id}")
 async def get_student(student_id: str, current_teacher: dict = Depends(get_current_teacher)):
@@ -229,7 +2242,7 @@ async def get_student(student_id: str, current_teacher: dict = Depends(get_curre
     })
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
-    return {"student": student}
+    return FastJSONResponse({"student": student})
 
 # Policy Management
 @app.get("/api/policies")
@@ -237,14 +2250,10 @@ async def get_policies(current_teacher: dict = Depends(get_current_teacher)):
     policy = await policies_collection.find_one({"teacher_id": current_teacher["_id"]})
     if not policy:
         raise HTTPException(status_code=404, detail="Policy not found")
-    return {"policy": policy}
+    return FastJSONResponse({"policy": policy})
 
 @app.put("/api/policies")
 async def update_policies(policy_update: PolicyUpdate, current_teacher: dict = Depends(get_current_teacher)):
-    policy = await policies_collection.find_one({"teacher_id": current_teacher["_id"]})
-    if not policy:
-        raise HTTPException(status_code=404, detail="Policy not found")
-    
     updated_policy = {
         "blocked_sites": policy_update.blocked_sites,
         "allowed_sites": policy_update.allowed_sites,
@@ -253,104 +2262,460 @@ async def update_policies(policy_update: PolicyUpdate, current_teacher: dict = D
         "updated_at": datetime.utcnow()
     }
     
-    await policies_collection.update_one(
+    # Bump the version so extensions holding an older ETag refetch
+    policy = await policies_collection.find_one_and_update(
         {"teacher_id": current_teacher["_id"]},
-        {"$set": updated_policy}
+        {"$set": updated_policy, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
     )
+    if not policy:
+        raise HTTPException(status_code=404, detail="Policy not found")
+    policy_cache.invalidate(current_teacher["_id"])
+    await policy_hub.publish(current_teacher["_id"], {
+        "type": "policy_changed",
+        "version": policy["version"],
+        "etag": policy_etag(current_teacher["_id"], policy["version"])
+    })
     
-    return {"message": "Policy updated successfully"}
+    return {"message": "Policy updated successfully", "version": policy["version"]}
 
 # Chrome Extension API Routes
 @app.post("/api/extension/policy")
-async def get_extension_policy(request: HashKeyRequest):
-    teacher = await teachers_collection.find_one({"hash_key": request.hash_key})
+async def get_extension_policy(
+    request: HashKeyRequest,
+    http_request: Request,
+    if_none_match: Optional[str] = Header(None)
+):
+    guard_extension_request(http_request, [request.hash_key])
+    teacher = await get_teacher_by_hash(request.hash_key)
     if not teacher:
         raise HTTPException(status_code=404, detail="Invalid hash key")
     
-    policy = await policies_collection.find_one({"teacher_id": teacher["_id"]})
-    if not policy:
+    cached = await get_extension_policy_entry(teacher["_id"])
+    if cached is None:
         raise HTTPException(status_code=404, detail="Policy not found")
     
-    return {
-        "blocked_sites": policy.get("blocked_sites", []),
-        "allowed_sites": policy.get("allowed_sites", {}),
-        "controlled_sites": policy.get("controlled_sites", []),
-        "daily_time_limit": policy.get("daily_time_limit", 3600)
-    }
+    if etag_matches(if_none_match, cached.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": cached.etag})
+    
+    return FastJSONResponse(cached.body, headers={"ETag": cached.etag})
 
-@app.post("/api/extension/usage")
-async def log_usage(usage: UsageLog):
-    # Find teacher by hash key
-    teacher = await teachers_collection.find_one({"hash_key": usage.student_hash})
+@app.get("/api/extension/policy/stream")
+async def stream_extension_policy(hash_key: str, http_request: Request):
+    guard_extension_request(http_request, [hash_key])
+    teacher = await get_teacher_by_hash(hash_key)
     if not teacher:
         raise HTTPException(status_code=404, detail="Invalid hash key")
     
-    # Log usage
-    usage_doc = {
-        "_id": str(uuid.uuid4()),
-        "teacher_id": teacher["_id"],
-        "student_hash": usage.student_hash,
-        "url": usage.url,
-        "title": usage.title,
-        "timestamp": usage.timestamp,
-        "duration": usage.duration,
-        "is_blocked": usage.is_blocked
-    }
+    cached = await get_extension_policy_entry(teacher["_id"])
+    if cached is None:
+        raise HTTPException(status_code=404, detail="Policy not found")
+    
+    def format_event(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
     
-    await usage_collection.insert_one(usage_doc)
+    async def event_stream():
+        queue = policy_hub.subscribe(teacher["_id"])
+        try:
+            # Current version first, so a reconnecting client can tell if it missed a change
+            yield format_event("policy", {"type": "policy", "version": cached.payload["version"], "etag": cached.etag})
+            
+            # Streams are recycled periodically; the client simply reconnects
+            deadline = time.monotonic() + POLICY_STREAM_MAX_SECONDS
+            while time.monotonic() < deadline:
+                try:
+                    message = await asyncio.wait_for(queue.get(), POLICY_STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_event("policy_changed", message)
+        finally:
+            policy_hub.unsubscribe(teacher["_id"], queue)
     
-    # Update student last active
-    await students_collection.update_one(
-        {"teacher_hash": usage.student_hash},
-        {"$set": {"last_active": usage.timestamp}}
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
+
+@app.post("/api/extension/usage")
+async def log_usage(usage: UsageLog, http_request: Request):
+    guard_extension_request(http_request, [usage.student_hash], priority="usage")
+    
+    # Find teacher by hash key
+    teacher = await get_teacher_by_hash(usage.student_hash)
+    if not teacher:
+        raise HTTPException(status_code=404, detail="Invalid hash key")
+    
+    # Queue usage; the write-behind buffer flushes it to Mongo in batches
+    usage_doc = build_usage_doc(usage, teacher["_id"])
+    
+    if not usage_buffer.running:
+        # Buffer is stopped (e.g. during shutdown); write directly
+        await usage_collection.insert_one((await encode_usage_docs([usage_doc]))[0])
+        await record_usage_side_effects([usage_doc])
+    elif not usage_buffer.submit(usage_doc):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Usage queue is full, retry later",
+            headers={"Retry-After": "1"}
+        )
     
     return {"message": "Usage logged successfully"}
 
+@app.post("/api/extension/usage/batch")
+async def log_usage_batch(batch: UsageBatch, http_request: Request):
+    hash_keys = list({event.student_hash for event in batch.events})
+    guard_extension_request(http_request, hash_keys, priority="usage")
+    
+    # Resolve every distinct hash key once, from cache or a single query
+    teachers = await get_teachers_by_hash(hash_keys)
+    teacher_ids = {hash_key: teacher["_id"] for hash_key, teacher in teachers.items()}
+    
+    results = []
+    usage_docs = []
+    doc_indexes = []
+    for index, event in enumerate(batch.events):
+        teacher_id = teacher_ids.get(event.student_hash)
+        if teacher_id is None:
+            results.append({"index": index, "status": "rejected", "detail": "Invalid hash key"})
+            continue
+        results.append({"index": index, "status": "accepted"})
+        usage_docs.append(build_usage_doc(event, teacher_id))
+        doc_indexes.append(index)
+    
+    # Write all events at once; unordered so one bad document does not stop the rest
+    failed = set()
+    if usage_docs:
+        try:
+            await usage_collection.insert_many(await encode_usage_docs(usage_docs), ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                index = doc_indexes[error["index"]]
+                failed.add(index)
+                results[index] = {"index": index, "status": "rejected", "detail": error.get("errmsg", "Write failed")}
+    
+    written = [doc for doc, index in zip(usage_docs, doc_indexes) if index not in failed]
+    await record_usage_side_effects(written)
+    
+    accepted = sum(1 for result in results if result["status"] == "accepted")
+    return {
+        "message": "Usage batch processed",
+        "accepted": accepted,
+        "rejected": len(results) - accepted,
+        "results": results
+    }
+
+# Admin Diagnostics
+@app.get("/api/extension/time-budget")
+async def get_time_budget(hash_key: str, http_request: Request, device_id: str = Query(..., min_length=1, max_length=64)):
+    # Remaining seconds today (UTC) per controlled site on this device, from the
+    # usage it has uploaded; survives the extension's local storage being reset
+    guard_extension_request(http_request, [hash_key])
+    teacher = await get_teacher_by_hash(hash_key)
+    if not teacher:
+        raise HTTPException(status_code=404, detail="Invalid hash key")
+    
+    entry = await get_extension_policy_entry(teacher["_id"])
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Policies not found")
+    
+    day = usage_day(datetime.utcnow())
+    daily_limit = entry.payload["daily_time_limit"]
+    used = await time_counters.used(hash_key, device_id, day)
+    return FastJSONResponse({
+        "day": day.date().isoformat(),
+        "daily_time_limit": daily_limit,
+        "domains": {
+            domain: {"used": used.get(domain, 0), "remaining": max(0, daily_limit - used.get(domain, 0))}
+            for domain in entry.matcher.controlled
+        }
+    })
+
+@app.get("/api/admin/query-plans", dependencies=[Depends(require_admin)])
+async def get_query_plans():
+    plans = await explain_hot_queries()
+    return {
+        "collscans": [plan["name"] for plan in plans if plan["collscan"]],
+        "plans": plans
+    }
+
+profiler = Profiler()
+
+@app.post("/api/admin/profile", dependencies=[Depends(require_admin)])
+async def run_profile(
+    seconds: float = Query(10, gt=0),
+    interval_ms: float = Query(5, ge=1, le=1000),
+    format: str = Query("collapsed", pattern="^(collapsed|speedscope)$"),
+    pid: Optional[int] = Query(None, description="Worker process to profile; any worker when omitted")
+):
+    # Samples this worker's event loop while requests keep flowing. Workers share
+    # the listening socket, so a call for another pid is answered with a 503 that
+    # the caller retries until it lands on that worker.
+    if pid is not None and pid != os.getpid():
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Reached worker {os.getpid()}, not {pid}; retry",
+            headers={"Retry-After": "0", "X-Profile-PID": str(os.getpid())}
+        )
+    if seconds > PROFILER_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be at most {PROFILER_MAX_SECONDS:g}")
+    if not profiler.try_acquire():
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A profile is already running in this worker")
+    try:
+        sampler = StackSampler(threading.get_ident(), interval_ms / 1000)
+        await asyncio.get_running_loop().run_in_executor(None, sampler.run, seconds)
+    finally:
+        profiler.release()
+
+    summary = sampler.summary()
+    headers = {
+        "X-Profile-PID": str(summary["pid"]),
+        "X-Profile-Samples": str(summary["samples"]),
+        "X-Profile-Idle-Samples": str(summary["idle_samples"])
+    }
+    if format == "speedscope":
+        return FastJSONResponse(sampler.speedscope(f"butterfly-buddy pid {summary['pid']}"), headers=headers)
+    return PlainTextResponse(sampler.collapsed(), headers=headers)
+
 # Dashboard Analytics
 @app.get("/api/dashboard/usage")
 async def get_usage_analytics(current_teacher: dict = Depends(get_current_teacher)):
-    # Get usage logs for past 7 days
+    # Totals and top domains for the past 7 days come from the hourly rollups
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
     
-    usage_logs = await usage_collection.find({
-        "teacher_id": current_teacher["_id"],
-        "timestamp": {"$gte": seven_days_ago}
-    }).to_list(1000)
+    summary = await analytics_rollups_collection.aggregate([
+        {"$match": {"teacher_id": current_teacher["_id"], "hour": {"$gte": usage_hour(seven_days_ago)}}},
+        {"$facet": {
+            "totals": [
+                {"$group": {"_id": None, "count": {"$sum": "$count"}, "blocked": {"$sum": "$blocked"}}}
+            ],
+            "top_domains": [
+                {"$group": {"_id": "$domain", "count": {"$sum": "$count"}, "blocked": {"$sum": "$blocked"}}},
+                {"$sort": {"count": -1}},
+                {"$limit": 10}
+            ]
+        }}
+    ]).to_list(1)
+    totals = summary[0]["totals"][0] if summary and summary[0]["totals"] else {"count": 0, "blocked": 0}
+    top_domains = summary[0]["top_domains"] if summary else []
+    
+    recent_logs = await analytics_usage_collection.find({
+        "t": teacher_key(current_teacher["_id"]),
+        "ts": {"$gte": seven_days_ago}
+    }).sort("ts", -1).limit(50).to_list(50)
     
     # Get blocked site attempts
-    blocked_attempts = await usage_collection.find({
-        "teacher_id": current_teacher["_id"],
-        "is_blocked": True,
-        "timestamp": {"$gte": seven_days_ago}
-    }).to_list(100)
+    blocked_logs = await analytics_usage_collection.find({
+        "t": teacher_key(current_teacher["_id"]),
+        "b": True,
+        "ts": {"$gte": seven_days_ago}
+    }).sort("ts", -1).limit(100).to_list(100)
     
-    return {
-        "total_usage": len(usage_logs),
-        "blocked_attempts": len(blocked_attempts),
-        "recent_logs": usage_logs[-50:],  # Last 50 logs
-        "blocked_logs": blocked_attempts
-    }
+    return FastJSONResponse({
+        "total_usage": totals["count"],
+        "blocked_attempts": totals["blocked"],
+        "top_domains": [
+            {"domain": domain["_id"], "count": domain["count"], "blocked": domain["blocked"]}
+            for domain in top_domains
+        ],
+        "recent_logs": await decode_usage_docs(recent_logs),  # Last 50 logs
+        "blocked_logs": await decode_usage_docs(blocked_logs)
+    })
+
+@app.get("/api/dashboard/usage/logs")
+async def get_usage_logs(
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    student_hash: Optional[str] = None,
+    blocked_only: bool = False,
+    current_teacher: dict = Depends(get_current_teacher)
+):
+    # Newest first by (timestamp, _id); pass next_cursor back as ?cursor= for older logs
+    query = {"t": teacher_key(current_teacher["_id"])}
+    if student_hash:
+        query["s"] = student_hash
+    if blocked_only:
+        query["b"] = True
+    if cursor:
+        timestamp, last_id = decode_cursor(cursor, timestamp=True)
+        query.update(keyset_filter("ts", timestamp, usage_log_id(last_id), descending=True))
+    logs = await analytics_usage_collection.find(query).sort([("ts", DESCENDING), ("_id", DESCENDING)]).limit(limit).to_list(limit)
+    logs = await decode_usage_docs(logs)
+    return FastJSONResponse({"logs": logs, "next_cursor": next_cursor(logs, "timestamp", limit)})
+
+@app.get("/api/dashboard/insights")
+async def get_usage_insights(
+    days: int = Query(7, ge=1, le=SKETCH_RETENTION_DAYS),
+    top: int = Query(20, ge=1, le=50),
+    scope: str = Query("teacher", pattern="^(teacher|school)$"),
+    current_teacher: dict = Depends(get_current_teacher)
+):
+    # Approximate top domains and distinct device counts from usage sketches
+    scope_id = current_teacher["_id"] if scope == "teacher" else current_teacher["school_name"]
+    sketch = await sketch_store.query(scope, scope_id, days)
+    return FastJSONResponse({"scope": scope, **sketch_summary(sketch, days, top)})
+
+@app.get("/api/admin/insights", dependencies=[Depends(require_admin)])
+async def get_admin_insights(
+    days: int = Query(7, ge=1, le=SKETCH_RETENTION_DAYS),
+    top: int = Query(20, ge=1, le=50),
+    school: Optional[str] = None
+):
+    # Across all teachers, or one school
+    scope, scope_id = ("school", school) if school else ("all", "all")
+    sketch = await sketch_store.query(scope, scope_id, days)
+    return FastJSONResponse({"scope": scope, "school": school, **sketch_summary(sketch, days, top)})
+
+# Set to False the first time the server rejects $topN (MongoDB < 5.2)
+topn_supported = True
+
+async def get_recent_activity(teacher_id: str, student_hashes: List[str], per_student: int = 10) -> Dict[str, list]:
+    global topn_supported
+    if not student_hashes:
+        return {}
+    
+    if topn_supported:
+        try:
+            groups = await analytics_usage_collection.aggregate([
+                {"$match": {"t": teacher_key(teacher_id), "s": {"$in": student_hashes}}},
+                {"$sort": {"ts": -1}},
+                {"$group": {
+                    "_id": "$s",
+                    "recent": {"$topN": {"n": per_student, "sortBy": {"ts": -1}, "output": "$$ROOT"}}
+                }}
+            ]).to_list(len(student_hashes))
+            return {group["_id"]: await decode_usage_docs(group["recent"]) for group in groups}
+        except OperationFailure:
+            logger.warning("$topN is not supported by this MongoDB server; using concurrent queries")
+            topn_supported = False
+    
+    # Fallback: one query per student, run concurrently with a bounded fan-out
+    semaphore = asyncio.Semaphore(ACTIVITY_QUERY_CONCURRENCY)
+    
+    async def fetch(student_hash: str):
+        async with semaphore:
+            logs = await analytics_usage_collection.find({
+                "t": teacher_key(teacher_id),
+                "s": student_hash
+            }).sort("ts", -1).limit(per_student).to_list(per_student)
+        return await decode_usage_docs(logs)
+    
+    results = await asyncio.gather(*(fetch(student_hash) for student_hash in student_hashes))
+    return dict(zip(student_hashes, results))
 
 @app.get("/api/dashboard/students/activity")
-async def get_student_activity(current_teacher: dict = Depends(get_current_teacher)):
-    students = await students_collection.find({"teacher_id": current_teacher["_id"]}).to_list(100)
-    
-    activity_data = []
-    for student in students:
-        # Get recent activity for this student
-        recent_usage = await usage_collection.find({
-            "teacher_id": current_teacher["_id"],
-            "student_hash": student["teacher_hash"]
-        }).sort("timestamp", -1).limit(10).to_list(10)
-        
-        activity_data.append({
+async def get_student_activity(
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    current_teacher: dict = Depends(get_current_teacher)
+):
+    # Same pages as /api/students; pass next_cursor back as ?cursor= for the next page
+    students = await get_student_page(current_teacher["_id"], limit, cursor)
+    
+    # Recent activity for the whole page in one aggregation
+    student_hashes = list({student["teacher_hash"] for student in students})
+    recent_activity = await get_recent_activity(current_teacher["_id"], student_hashes)
+    
+    activity_data = [
+        {
             "student": student,
-            "recent_activity": recent_usage
-        })
+            "recent_activity": recent_activity.get(student["teacher_hash"], [])
+        }
+        for student in students
+    ]
     
-    return {"student_activity": activity_data}
+    return FastJSONResponse({
+        "student_activity": activity_data,
+        "next_cursor": next_cursor(students, "name", limit)
+    })
+
+# Usage export
+EXPORT_FIELDS = ["_id", "student_hash", "url", "title", "timestamp", "duration", "is_blocked"]
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def csv_cell(value) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    # Keep spreadsheet apps from evaluating page titles/URLs as formulas
+    if isinstance(value, str) and value[:1] in ("=", "+", "-", "@"):
+        return "'" + value
+    return value
+
+def csv_line(values: list) -> bytes:
+    line = io.StringIO()
+    csv.writer(line).writerow(values)
+    return line.getvalue().encode()
+
+async def stream_usage_export(query: dict, export_format: str, compress: bool):
+    # Rows are read batch by batch and flushed in ~64KB chunks, so memory stays
+    # flat regardless of how many documents match
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31: gzip framing
+    chunk = bytearray()
+    if export_format == "csv":
+        chunk += csv_line(EXPORT_FIELDS)
+
+    cursor = analytics_usage_collection.find(query, {"t": 0}).sort("ts", ASCENDING).batch_size(EXPORT_BATCH_SIZE)
+    while True:
+        # Decode a whole batch at once so URL prefixes are looked up once per batch
+        batch = await cursor.to_list(EXPORT_BATCH_SIZE)
+        if not batch:
+            break
+        for doc in await decode_usage_docs(batch):
+            if export_format == "csv":
+                chunk += csv_line([csv_cell(doc.get(field)) for field in EXPORT_FIELDS])
+            else:
+                chunk += dump_json(doc) + b"\n"
+            if len(chunk) >= EXPORT_CHUNK_BYTES:
+                data = compressor.compress(bytes(chunk)) if compressor else bytes(chunk)
+                chunk.clear()
+                if data:
+                    yield data
+
+    data = compressor.compress(bytes(chunk)) + compressor.flush() if compressor else bytes(chunk)
+    if data:
+        yield data
+
+@app.get("/api/dashboard/usage/export")
+async def export_usage(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    student_hash: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    blocked_only: bool = False,
+    accept_encoding: Optional[str] = Header(None),
+    current_teacher: dict = Depends(get_current_teacher)
+):
+    query = {"t": teacher_key(current_teacher["_id"])}
+    if student_hash:
+        query["s"] = student_hash
+    if blocked_only:
+        query["b"] = True
+    if start or end:
+        query["ts"] = {}
+        if start:
+            query["ts"]["$gte"] = to_naive_utc(start)
+        if end:
+            query["ts"]["$lt"] = to_naive_utc(end)
+
+    compress = "gzip" in (accept_encoding or "").lower()
+    headers = {
+        "Content-Disposition": f'attachment; filename="usage-export.{format}"',
+        "Vary": "Accept-Encoding"
+    }
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(stream_usage_export(query, format, compress), media_type=media_type, headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # Workers are separate processes that import the app themselves, so nothing
+    # (Mongo pool, caches, usage buffer) is shared across a fork
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=8001,
+        workers=WEB_CONCURRENCY,
+        timeout_graceful_shutdown=GRACEFUL_SHUTDOWN_SECONDS
+    )
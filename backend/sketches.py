@@ -0,0 +1,177 @@
+import hashlib
+import math
+import struct
+import sys
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Mergeable probabilistic sketches for usage analytics.
+#
+# HyperLogLog estimates distinct counts, CountMinSketch estimates per-item
+# frequencies, and TopK pairs a CountMinSketch with a bounded candidate set to
+# track heavy hitters. All of them serialize to compact bytes and merge with
+# sketches of the same dimensions, so per-worker, per-day sketches can be
+# stored separately and combined at query time. Hashes come from blake2b, not
+# hash(), so sketches built in different processes agree.
+
+FORMAT_VERSION = 1
+
+def hash64(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+class HyperLogLog:
+    HEADER = struct.Struct(">BB")  # version, precision
+
+    def __init__(self, precision: int = 11, registers: Optional[bytearray] = None):
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+
+    def add(self, value: str):
+        hashed = hash64(value)
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # Small-range correction (linear counting)
+            estimate = self.size * math.log(self.size / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return self.HEADER.pack(FORMAT_VERSION, self.precision) + bytes(self.registers)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        version, precision = cls.HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported sketch version {version}")
+        registers = bytearray(data[cls.HEADER.size:])
+        if len(registers) != 1 << precision:
+            raise ValueError("Truncated HyperLogLog")
+        return cls(precision, registers)
+
+class CountMinSketch:
+    HEADER = struct.Struct(">BHBQ")  # version, width, depth, total
+
+    def __init__(self, width: int = 1024, depth: int = 4, counters: Optional[array] = None, total: int = 0):
+        if depth > 4:
+            raise ValueError("depth must be at most 4")
+        self.width = width
+        self.depth = depth
+        self.counters = counters if counters is not None else array("I", bytes(4 * width * depth))
+        self.total = total
+
+    def _cells(self, item: str) -> List[int]:
+        # One 128-bit hash split into `depth` 32-bit row hashes
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        return [
+            row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], "big") % self.width
+            for row in range(self.depth)
+        ]
+
+    def add(self, item: str, count: int = 1) -> int:
+        # Returns the item's estimated count after the update
+        self.total += count
+        estimate = None
+        for cell in self._cells(item):
+            self.counters[cell] += count
+            value = self.counters[cell]
+            estimate = value if estimate is None or value < estimate else estimate
+        return estimate
+
+    def estimate(self, item: str) -> int:
+        return min(self.counters[cell] for cell in self._cells(item))
+
+    def merge(self, other: "CountMinSketch"):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("Cannot merge CountMinSketches of different dimensions")
+        self.counters = array("I", map(int.__add__, self.counters, other.counters))
+        self.total += other.total
+
+    def to_bytes(self) -> bytes:
+        counters = array("I", self.counters)
+        if sys.byteorder == "little":
+            counters.byteswap()  # stored big-endian
+        return self.HEADER.pack(FORMAT_VERSION, self.width, self.depth, self.total) + counters.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Tuple["CountMinSketch", int]:
+        # Returns the sketch and the number of bytes consumed
+        version, width, depth, total = cls.HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Unsupported sketch version {version}")
+        end = cls.HEADER.size + 4 * width * depth
+        counters = array("I")
+        counters.frombytes(data[cls.HEADER.size:end])
+        if sys.byteorder == "little":
+            counters.byteswap()
+        return cls(width, depth, counters, total), end
+
+class TopK:
+    # Heavy hitters: frequencies from a CountMinSketch, plus the `capacity`
+    # items with the highest estimates seen so far
+    def __init__(self, capacity: int = 64, sketch: Optional[CountMinSketch] = None, candidates: Optional[Dict[str, int]] = None):
+        self.capacity = capacity
+        self.sketch = sketch or CountMinSketch()
+        self.candidates = candidates or {}
+
+    def add(self, item: str, count: int = 1):
+        estimate = self.sketch.add(item, count)
+        if item in self.candidates or len(self.candidates) < self.capacity:
+            self.candidates[item] = estimate
+            return
+        smallest = min(self.candidates, key=self.candidates.get)
+        if estimate > self.candidates[smallest]:
+            del self.candidates[smallest]
+            self.candidates[item] = estimate
+
+    def merge(self, other: "TopK"):
+        self.sketch.merge(other.sketch)
+        self._retain(set(self.candidates) | set(other.candidates))
+
+    def _retain(self, items: Iterable[str]):
+        estimates = {item: self.sketch.estimate(item) for item in items}
+        self.candidates = dict(sorted(estimates.items(), key=lambda entry: -entry[1])[:self.capacity])
+
+    def top(self, count: int) -> List[Tuple[str, int]]:
+        return sorted(self.candidates.items(), key=lambda entry: -entry[1])[:count]
+
+    @property
+    def total(self) -> int:
+        return self.sketch.total
+
+    def to_bytes(self) -> bytes:
+        parts = [self.sketch.to_bytes(), struct.pack(">H", len(self.candidates))]
+        for item in self.candidates:
+            encoded = item.encode()
+            parts.append(struct.pack(">H", len(encoded)) + encoded)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, capacity: int = 64) -> "TopK":
+        sketch, offset = CountMinSketch.from_bytes(data)
+        (count,) = struct.unpack_from(">H", data, offset)
+        offset += 2
+        items = []
+        for _ in range(count):
+            (length,) = struct.unpack_from(">H", data, offset)
+            offset += 2
+            items.append(data[offset:offset + length].decode())
+            offset += length
+        top = cls(capacity, sketch)
+        top._retain(items)
+        return top
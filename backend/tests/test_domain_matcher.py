@@ -0,0 +1,35 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from domain_matcher import DomainMatcher, compile_rules, normalize_host
+
+# Unit tests for blocked/controlled site matching. Run from the backend directory:
+#   python -m pytest tests
+
+def test_rule_matches_only_on_label_boundary():
+    matcher = DomainMatcher(blocked_sites=["x.com"])
+    assert matcher.match_blocked("https://x.com/home") == "x.com"
+    assert matcher.match_blocked("https://api.x.com/v2") == "x.com"
+    assert matcher.match_blocked("https://box.com/files") is None
+    assert matcher.match_blocked("https://x.com.evil.example/") is None
+
+def test_hosts_and_rules_are_normalized():
+    matcher = DomainMatcher(controlled_sites=["*.YouTube.com", "www.facebook.com/"])
+    assert matcher.controlled == ["facebook.com", "youtube.com"]
+    assert matcher.match_controlled("HTTPS://WWW.YOUTUBE.COM:443/watch?v=1") == "youtube.com"
+    assert matcher.match_controlled("m.facebook.com") == "facebook.com"
+
+def test_rules_covered_by_a_parent_are_dropped():
+    assert compile_rules(["mail.google.com", "google.com", "", "google.com."]) == ["google.com"]
+
+def test_malformed_urls_match_nothing():
+    assert normalize_host("http://[x/") == ""
+    assert normalize_host("") == ""
+    assert normalize_host(None) == ""
+    assert DomainMatcher(blocked_sites=["x.com"]).match_blocked("http://[x.com/") is None
+
+def test_payload_lists_compiled_rules():
+    payload = DomainMatcher(["b.com", "a.com"], ["c.com"]).to_payload()
+    assert payload == {"format": "suffix-set/1", "blocked": ["a.com", "b.com"], "controlled": ["c.com"]}
@@ -0,0 +1,95 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from sketches import CountMinSketch, HyperLogLog, TopK
+
+# Unit tests for the usage sketches. Run from the backend directory:
+#   python -m pytest tests
+
+def test_hyperloglog_estimates_distinct_count():
+    hll = HyperLogLog(precision=10)
+    for index in range(20000):
+        hll.add(f"device-{index % 5000}")
+    assert abs(hll.count() - 5000) / 5000 < 0.08
+
+def test_hyperloglog_small_counts_are_exact_enough():
+    hll = HyperLogLog(precision=10)
+    for index in range(7):
+        hll.add(f"device-{index}")
+    assert hll.count() == 7
+
+def test_hyperloglog_merge_is_union():
+    left, right, both = HyperLogLog(10), HyperLogLog(10), HyperLogLog(10)
+    for index in range(3000):
+        (left if index % 2 else right).add(str(index))
+        both.add(str(index))
+    left.merge(right)
+    assert left.registers == both.registers
+
+def test_hyperloglog_round_trip():
+    hll = HyperLogLog(10)
+    for index in range(100):
+        hll.add(str(index))
+    restored = HyperLogLog.from_bytes(hll.to_bytes())
+    assert restored.precision == 10
+    assert restored.count() == hll.count()
+
+def test_hyperloglog_rejects_other_precision():
+    with pytest.raises(ValueError):
+        HyperLogLog(10).merge(HyperLogLog(11))
+    with pytest.raises(ValueError):
+        HyperLogLog.from_bytes(HyperLogLog(10).to_bytes()[:-1])
+
+def test_count_min_sketch_never_underestimates():
+    cms = CountMinSketch(width=64, depth=4)
+    counts = {f"site{index}.com": index + 1 for index in range(200)}
+    for item, count in counts.items():
+        cms.add(item, count)
+    assert all(cms.estimate(item) >= count for item, count in counts.items())
+    assert cms.total == sum(counts.values())
+
+def test_count_min_sketch_add_returns_estimate():
+    cms = CountMinSketch(width=256)
+    cms.add("a.com", 3)
+    assert cms.add("a.com") == cms.estimate("a.com") == 4
+
+def test_count_min_sketch_round_trip_and_merge():
+    left, right = CountMinSketch(width=128), CountMinSketch(width=128)
+    left.add("a.com", 5)
+    right.add("a.com", 2)
+    right.add("b.com", 1)
+    restored, consumed = CountMinSketch.from_bytes(right.to_bytes())
+    assert consumed == len(right.to_bytes())
+    left.merge(restored)
+    assert left.estimate("a.com") >= 7
+    assert left.total == 8
+
+def test_count_min_sketch_rejects_other_dimensions():
+    with pytest.raises(ValueError):
+        CountMinSketch(width=128).merge(CountMinSketch(width=256))
+
+def test_topk_keeps_heavy_hitters():
+    top = TopK(capacity=8, sketch=CountMinSketch(width=256))
+    for index in range(2000):
+        top.add(f"rare{index}.com")
+        if index % 4 == 0:
+            top.add("heavy.com")
+        if index % 10 == 0:
+            top.add("medium.com")
+    assert [item for item, _ in top.top(2)] == ["heavy.com", "medium.com"]
+    assert top.total == 2000 + 500 + 200
+
+def test_topk_merge_and_round_trip():
+    left = TopK(capacity=4, sketch=CountMinSketch(width=256))
+    right = TopK(capacity=4, sketch=CountMinSketch(width=256))
+    for _ in range(10):
+        left.add("a.com")
+        right.add("b.com")
+    right.add("b.com")
+    left.merge(TopK.from_bytes(right.to_bytes(), capacity=4))
+    assert left.top(2) == [("b.com", 11), ("a.com", 10)]
+    assert left.total == 21
@@ -1,5 +1,6 @@
 
 import requests
+import gzip
 import json
 from datetime import datetime
 import time
@@ -157,6 +158,40 @@ def test_student_management():
     print("✅ Student management passed")
     return True
 
+def test_student_import():
+    print("\n=== Testing Student Import ===")
+    headers = {"Authorization": f"Bearer {teacher_token}", "Content-Type": "text/csv"}
+    suffix = random.randint(10000, 99999)
+    roster = (
+        "name,student_id,class_name,grade\n"
+        f'"Doe, Jane",I{suffix}-1,Class A,7\n'
+        f'Dwayne O"Neil,I{suffix}-2,Class A,7\n'  # Stray quote in an unquoted field
+        f'"Multi\nline",I{suffix}-3,Class A,7\n'
+        "No Id,,Class A,7\n"
+        f"Repeat,I{suffix}-1,Class A,7\n"
+    )
+    
+    response = requests.post(f"{BASE_URL}/students/import?dry_run=true", data=roster.encode(), headers=headers)
+    print(f"Dry run Status Code: {response.status_code}")
+    print(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 3
+    assert response.json()["error_count"] == 2
+    
+    response = requests.post(f"{BASE_URL}/students/import", data=gzip.compress(roster.encode()), headers={**headers, "Content-Encoding": "gzip"})
+    print(f"Import Status Code: {response.status_code}")
+    print(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 3
+    assert [error["row"] for error in response.json()["errors"]] == [4, 5]
+    
+    response = requests.post(f"{BASE_URL}/students/import", data=roster.encode(), headers=headers)
+    assert response.json()["inserted"] == 0
+    assert all(error["error"] for error in response.json()["errors"])
+    
+    print("✅ Student import passed")
+    return True
+
 def test_policy_management():
     print("\n=== Testing Policy Management ===")
     
@@ -208,6 +243,19 @@ def test_extension_api():
     assert "blocked_sites" in response.json()
     assert "allowed_sites" in response.json()
     assert "daily_time_limit" in response.json()
+    assert "ETag" in response.headers
+
+    # Test conditional policy fetch with the returned ETag
+    response = requests.post(
+        f"{BASE_URL}/extension/policy",
+        json={"hash_key": teacher_hash_key},
+        headers={"If-None-Match": response.headers["ETag"]}
+    )
+    print(f"\nGetting policy with If-None-Match")
+    print(f"Status Code: {response.status_code}")
+
+    assert response.status_code == 304
+    assert response.content == b""
     
     # Test logging usage
     test_usage_log["student_hash"] = teacher_hash_key
@@ -220,7 +268,25 @@ def test_extension_api():
     
     assert response.status_code == 200
     assert "message" in response.json()
-    
+
+    # Test batched usage logging with one invalid hash key
+    batch = {
+        "events": [
+            dict(test_usage_log, timestamp=datetime.utcnow().isoformat()),
+            dict(test_usage_log, student_hash="XXXXX", timestamp=datetime.utcnow().isoformat())
+        ]
+    }
+
+    response = requests.post(f"{BASE_URL}/extension/usage/batch", json=batch)
+    print(f"\nLogging usage batch")
+    print(f"Status Code: {response.status_code}")
+    print(f"Response: {response.json()}")
+
+    assert response.status_code == 200
+    assert response.json()["accepted"] == 1
+    assert response.json()["rejected"] == 1
+    assert response.json()["results"][1]["status"] == "rejected"
+
     print("✅ Extension API passed")
     return True
 
@@ -258,6 +324,7 @@ def run_all_tests():
         ("Teacher Registration", test_teacher_registration),
         ("Teacher Login", test_teacher_login),
         ("Student Management", test_student_management),
+        ("Student Import", test_student_import),
         ("Policy Management", test_policy_management),
         ("Extension API", test_extension_api),
         ("Analytics", test_analytics)
@@ -1,19 +1,49 @@
 // Background Service Worker for Manifest V3
 // Enhanced with backend API integration
 
+import './js/domain-matcher.js';
+
+const ACTIVITY_BUFFER_SIZE = 500; // Ring buffer capacity; the oldest records are dropped when full
+const ACTIVITY_FLUSH_THRESHOLD = 50; // Upload as soon as this many records are waiting
+const ACTIVITY_FLUSH_INTERVAL = 60 * 1000;
+const PENDING_USAGE_LIMIT = 2000; // Records kept in storage while the server is unreachable
+const TIME_USAGE_PERSIST_INTERVAL = 30 * 1000;
+const TIME_BUDGET_MAX_AGE = 30 * 1000; // How long a server time budget is reused
+const POLICY_REFETCH_SPREAD = 30 * 1000; // Refetches after a push are spread so a class doesn't arrive at once
+
+// Daily limits reset at midnight UTC, the same day boundary the server counts by
+function usageDay() {
+  return new Date().toISOString().slice(0, 10);
+}
+
 class ButterflyBackgroundAPI {
   constructor() {
     this.baseURL = 'http://localhost:8001/api';
     this.hashKey = null;
+    this.deviceId = null; // Tells this device's usage apart from the rest of the class
     this.policies = null;
-    this.timeTracking = new Map(); // Track time spent on controlled sites
+    this.matcher = null;
+    this.matcherPolicies = null; // Policies object the matcher was built from
+    this.policyStream = null; // AbortController for the open policy stream
+    this.streamRetryDelay = 1000;
+    this.policyRefetchTimer = null;
+    this.openVisits = new Map(); // tabId -> visit not recorded yet
+    this.activeTabId = null; // Tab in front of the student; null while the browser is unfocused or idle
+    this.activityBuffer = []; // Finished visits waiting to be uploaded
+    this.flushing = false;
+    this.timeUsage = new Map(); // storage key -> seconds, written back periodically
+    this.dirtyTimeUsage = new Set();
+    this.timeBudget = null; // Last budget from the server for this device
     this.init();
   }
 
   async init() {
+    await this.loadDeviceId();
+    await this.refreshActiveTab();
     await this.loadHashKey();
     if (this.hashKey) {
       await this.loadPolicies();
+      this.startPolicyStream();
     }
   }
 
@@ -26,21 +56,47 @@ class ButterflyBackgroundAPI {
     }
   }
 
+  async loadDeviceId() {
+    const stored = await chrome.storage.local.get(['butterflyDeviceId']);
+    this.deviceId = stored.butterflyDeviceId;
+    if (!this.deviceId) {
+      this.deviceId = crypto.randomUUID();
+      await chrome.storage.local.set({ butterflyDeviceId: this.deviceId });
+    }
+  }
+
   async loadPolicies() {
     if (!this.hashKey) return;
 
     try {
+      const stored = await chrome.storage.local.get(['butterflyPolicies', 'butterflyPoliciesETag']);
+      const headers = {
+        'Content-Type': 'application/json',
+      };
+      // Only revalidate when we still hold the policies the ETag refers to
+      if (stored.butterflyPolicies && stored.butterflyPoliciesETag) {
+        headers['If-None-Match'] = stored.butterflyPoliciesETag;
+      }
+
       const response = await fetch(`${this.baseURL}/extension/policy`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
+        headers: headers,
         body: JSON.stringify({ hash_key: this.hashKey })
       });
 
-      if (response.ok) {
+      if (response.status === 304) {
+        this.policies = stored.butterflyPolicies;
+      } else if (response.status === 429) {
+        // Rate limited: keep what we have and try again once the server allows it
+        this.policies = this.policies || stored.butterflyPolicies;
+        const retryAfter = Number(response.headers.get('Retry-After')) || 1;
+        this.schedulePolicyRefetch(retryAfter * 1000);
+      } else if (response.ok) {
         this.policies = await response.json();
-        await chrome.storage.local.set({ butterflyPolicies: this.policies });
+        await chrome.storage.local.set({
+          butterflyPolicies: this.policies,
+          butterflyPoliciesETag: response.headers.get('ETag')
+        });
       }
     } catch (error) {
       console.error('Error loading policies:', error);
@@ -50,26 +106,226 @@ class ButterflyBackgroundAPI {
     }
   }
 
-  async logActivity(url, title, isBlocked = false, tabId = null) {
+  // Keep a server-sent event stream open so policy changes apply right away.
+  // Periodic polling stays in place as the fallback whenever the stream is down.
+  async startPolicyStream() {
+    if (!this.hashKey || this.policyStream) return;
+
+    const controller = new AbortController();
+    this.policyStream = controller;
+
+    try {
+      const response = await fetch(
+        `${this.baseURL}/extension/policy/stream?hash_key=${encodeURIComponent(this.hashKey)}`,
+        { headers: { 'Accept': 'text/event-stream' }, signal: controller.signal }
+      );
+      if (!response.ok) {
+        throw new Error(`Policy stream failed: ${response.status}`);
+      }
+
+      this.streamRetryDelay = 1000;
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += value;
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+          const rawEvent = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          await this.handlePolicyEvent(rawEvent);
+        }
+      }
+    } catch (error) {
+      if (error.name !== 'AbortError') {
+        console.error('Policy stream error:', error);
+      }
+    } finally {
+      if (this.policyStream === controller) {
+        this.policyStream = null;
+      }
+    }
+
+    if (!controller.signal.aborted) {
+      setTimeout(() => this.startPolicyStream(), this.streamRetryDelay);
+      this.streamRetryDelay = Math.min(this.streamRetryDelay * 2, 5 * 60 * 1000);
+    }
+  }
+
+  stopPolicyStream() {
+    if (this.policyStream) {
+      this.policyStream.abort();
+      this.policyStream = null;
+    }
+  }
+
+  async handlePolicyEvent(rawEvent) {
+    let data = null;
+    for (const line of rawEvent.split('\n')) {
+      if (line.startsWith('data:')) {
+        data = JSON.parse(line.slice(5));
+      }
+    }
+    if (!data || !data.etag) return; // keepalive comment
+
+    const stored = await chrome.storage.local.get(['butterflyPoliciesETag']);
+    if (stored.butterflyPoliciesETag !== data.etag) {
+      this.schedulePolicyRefetch(0);
+    }
+  }
+
+  // Every device in the class receives the same push; a random delay keeps their
+  // refetches under the per-class rate limit. One refetch is pending at a time.
+  schedulePolicyRefetch(minDelay) {
+    if (this.policyRefetchTimer) return;
+    this.policyRefetchTimer = setTimeout(() => {
+      this.policyRefetchTimer = null;
+      this.loadPolicies();
+    }, minDelay + Math.random() * POLICY_REFETCH_SPREAD);
+  }
+
+  // Visits are coalesced in memory: navigating within the same URL extends the
+  // open visit, and a visit is recorded once the tab moves on or closes. Its
+  // duration only counts time the tab was in front of the student, so a tab
+  // left in the background does not use up a controlled site's daily limit.
+  // Blocked attempts are recorded immediately.
+  logActivity(url, title, isBlocked = false, tabId = null) {
     if (!this.hashKey) return;
 
+    if (isBlocked || tabId === null) {
+      this.bufferActivity({ url, title, timestamp: new Date().toISOString(), duration: 0, is_blocked: isBlocked });
+      return;
+    }
+
+    const open = this.openVisits.get(tabId);
+    if (open && open.url === url) {
+      open.title = title;
+      return;
+    }
+    this.closeVisit(tabId);
+    const now = Date.now();
+    this.openVisits.set(tabId, {
+      url,
+      title,
+      startTime: now,
+      activeMs: 0,
+      activeSince: tabId === this.activeTabId ? now : null
+    });
+  }
+
+  // A tab is navigating to url: stop the clock on whatever it showed before,
+  // including when the new page is never logged (blocked page, chrome:// URLs)
+  leaveVisit(tabId, url) {
+    const visit = this.openVisits.get(tabId);
+    if (visit && visit.url !== url) {
+      this.closeVisit(tabId);
+    }
+  }
+
+  closeVisit(tabId) {
+    const visit = this.openVisits.get(tabId);
+    if (!visit) return;
+    this.openVisits.delete(tabId);
+    this.pauseVisit(visit);
+    this.bufferActivity({
+      url: visit.url,
+      title: visit.title,
+      timestamp: new Date(visit.startTime).toISOString(),
+      duration: Math.floor(visit.activeMs / 1000),
+      is_blocked: false
+    });
+  }
+
+  // Ends the visit's current stretch in front of the student. Controlled-site
+  // time is added to the local daily counter from the same stretches that make
+  // up the uploaded duration, so the local and server counters agree.
+  pauseVisit(visit) {
+    if (visit.activeSince === null) return;
+    const elapsed = Date.now() - visit.activeSince;
+    visit.activeMs += elapsed;
+    visit.activeSince = null;
+    const rule = this.controlledRule(visit.url);
+    if (rule && elapsed > 0) {
+      this.updateTimeUsage(rule, elapsed / 1000);
+    }
+  }
+
+  // Moves the clock to tabId's visit; null stops it on every tab
+  setActiveTab(tabId) {
+    if (tabId === this.activeTabId) return;
+    const previous = this.openVisits.get(this.activeTabId);
+    if (previous) {
+      this.pauseVisit(previous);
+    }
+    this.activeTabId = tabId;
+    const current = this.openVisits.get(tabId);
+    if (current && current.activeSince === null) {
+      current.activeSince = Date.now();
+    }
+  }
+
+  async refreshActiveTab() {
     try {
-      await fetch(`${this.baseURL}/extension/usage`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          student_hash: this.hashKey,
-          url: url,
-          title: title,
-          timestamp: new Date().toISOString(),
-          duration: 0,
-          is_blocked: isBlocked
-        })
-      });
+      const [tab] = await chrome.tabs.query({ active: true, lastFocusedWindow: true });
+      this.setActiveTab(tab ? tab.id : null);
     } catch (error) {
-      console.error('Error logging activity:', error);
+      console.error('Error finding the active tab:', error);
+    }
+  }
+
+  bufferActivity(record) {
+    this.activityBuffer.push({ student_hash: this.hashKey, device_id: this.deviceId, ...record });
+    if (this.activityBuffer.length > ACTIVITY_BUFFER_SIZE) {
+      this.activityBuffer.shift();
+    }
+    if (this.activityBuffer.length >= ACTIVITY_FLUSH_THRESHOLD) {
+      this.flushActivity();
+    }
+  }
+
+  // Upload buffered records, plus anything left over from failed uploads, as
+  // one gzip-compressed batch. On failure the records are kept in storage.
+  async flushActivity() {
+    if (this.flushing) return;
+    this.flushing = true;
+
+    const stored = await chrome.storage.local.get(['butterflyPendingUsage']);
+    const events = (stored.butterflyPendingUsage || []).concat(this.activityBuffer.splice(0));
+    let start = 0;
+    try {
+      for (; start < events.length; start += ACTIVITY_BUFFER_SIZE) {
+        await this.uploadActivity(events.slice(start, start + ACTIVITY_BUFFER_SIZE));
+      }
+      if (stored.butterflyPendingUsage) {
+        await chrome.storage.local.remove('butterflyPendingUsage');
+      }
+    } catch (error) {
+      console.error('Error uploading activity, will retry:', error);
+      await chrome.storage.local.set({ butterflyPendingUsage: events.slice(start).slice(-PENDING_USAGE_LIMIT) });
+    } finally {
+      this.flushing = false;
+    }
+  }
+
+  async uploadActivity(events) {
+    const body = JSON.stringify({ events });
+    const headers = { 'Content-Type': 'application/json' };
+    let payload = body;
+    if (typeof CompressionStream !== 'undefined') {
+      const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+      payload = await new Response(stream).arrayBuffer();
+      headers['Content-Encoding'] = 'gzip';
+    }
+
+    const response = await fetch(`${this.baseURL}/extension/usage/batch`, {
+      method: 'POST',
+      headers: headers,
+      body: payload
+    });
+    // Events rejected individually (e.g. unknown hash key) are not retried
+    if (!response.ok && response.status !== 422) {
+      throw new Error(`Usage upload failed: ${response.status}`);
     }
   }
 
@@ -81,49 +337,92 @@ class ButterflyBackgroundAPI {
     }
   }
 
+  getMatcher() {
+    if (this.matcherPolicies !== this.policies) {
+      this.matcher = DomainMatcher.fromPolicies(this.policies);
+      this.matcherPolicies = this.policies;
+    }
+    return this.matcher;
+  }
+
   isBlocked(url) {
     if (!this.policies) return false;
-    
-    const domain = this.extractDomain(url);
-    return this.policies.blocked_sites.some(blocked => 
-      domain.includes(blocked) || blocked.includes(domain)
-    );
+    return this.getMatcher().matchBlocked(url) !== null;
   }
 
   isControlled(url) {
     if (!this.policies) return false;
-    
-    const domain = this.extractDomain(url);
-    return this.policies.controlled_sites.some(controlled => 
-      domain.includes(controlled) || controlled.includes(domain)
-    );
+    return this.getMatcher().matchControlled(url) !== null;
+  }
+
+  // The controlled-site rule a URL falls under; time is counted per rule, as on the server
+  controlledRule(url) {
+    if (!this.policies) return null;
+    return this.getMatcher().matchControlled(url);
   }
 
   async checkTimeLimit(domain, tabId) {
     if (!this.policies) return true;
 
     const dailyLimit = this.policies.daily_time_limit || 3600; // seconds
-    const today = new Date().toDateString();
-    
-    // Get today's usage for this domain
-    const storageKey = `timeUsage_${domain}_${today}`;
-    const result = await chrome.storage.local.get([storageKey]);
-    const usedTime = result[storageKey] || 0;
+    const localUsed = await this.getTimeUsage(`timeUsage_${domain}_${usageDay()}`);
+    // The server total is this device's uploaded usage: it survives local storage
+    // being cleared but lags by the visits not uploaded yet, so enforce the higher
+    const budget = await this.loadTimeBudget();
+    const serverUsed = budget?.domains?.[domain]?.used || 0;
+
+    return Math.max(localUsed, serverUsed) < dailyLimit;
+  }
+
+  async loadTimeBudget() {
+    if (!this.hashKey || !this.deviceId) return null;
+    if (this.timeBudget && Date.now() - this.timeBudget.fetchedAt < TIME_BUDGET_MAX_AGE) {
+      return this.timeBudget;
+    }
 
-    return usedTime < dailyLimit;
+    try {
+      const response = await fetch(
+        `${this.baseURL}/extension/time-budget?hash_key=${encodeURIComponent(this.hashKey)}` +
+          `&device_id=${encodeURIComponent(this.deviceId)}`
+      );
+      if (response.ok) {
+        this.timeBudget = { ...(await response.json()), fetchedAt: Date.now() };
+      }
+    } catch (error) {
+      console.error('Error loading time budget:', error);
+    }
+    return this.timeBudget; // Possibly stale, or null when offline: local usage still applies
+  }
+
+  // Time usage is served from memory; storage is read once per key and
+  // written back in one batch by persistTimeUsage()
+  async getTimeUsage(storageKey) {
+    if (!this.timeUsage.has(storageKey)) {
+      const result = await chrome.storage.local.get([storageKey]);
+      if (!this.timeUsage.has(storageKey)) {
+        this.timeUsage.set(storageKey, result[storageKey] || 0);
+      }
+    }
+    return this.timeUsage.get(storageKey);
   }
 
   async updateTimeUsage(domain, seconds) {
-    const today = new Date().toDateString();
-    const storageKey = `timeUsage_${domain}_${today}`;
-    
-    const result = await chrome.storage.local.get([storageKey]);
-    const currentUsage = result[storageKey] || 0;
-    const newUsage = currentUsage + seconds;
-    
-    await chrome.storage.local.set({ [storageKey]: newUsage });
+    const storageKey = `timeUsage_${domain}_${usageDay()}`;
+    const newUsage = (await this.getTimeUsage(storageKey)) + seconds;
+    this.timeUsage.set(storageKey, newUsage);
+    this.dirtyTimeUsage.add(storageKey);
     return newUsage;
   }
+
+  async persistTimeUsage() {
+    if (this.dirtyTimeUsage.size === 0) return;
+    const updates = {};
+    for (const storageKey of this.dirtyTimeUsage) {
+      updates[storageKey] = this.timeUsage.get(storageKey);
+    }
+    this.dirtyTimeUsage.clear();
+    await chrome.storage.local.set(updates);
+  }
 }
 
 // Global API instance
@@ -150,6 +449,7 @@ chrome.runtime.onInstalled.addListener(async () => {
 chrome.webNavigation.onBeforeNavigate.addListener(async (details) => {
   if (details.frameId === 0) { // Main frame only
     const url = details.url;
+    butterflyAPI.leaveVisit(details.tabId, url);
     
     // Skip chrome:// and extension URLs
     if (url.startsWith('chrome://') || url.startsWith('chrome-extension://')) {
@@ -163,7 +463,7 @@ chrome.webNavigation.onBeforeNavigate.addListener(async (details) => {
       // Log blocked attempt
       try {
         const tab = await chrome.tabs.get(details.tabId);
-        await butterflyAPI.logActivity(url, tab.title || 'Blocked Page', true, details.tabId);
+        butterflyAPI.logActivity(url, tab.title || 'Blocked Page', true, details.tabId);
       } catch (error) {
         console.error('Error logging blocked activity:', error);
       }
@@ -177,7 +477,7 @@ chrome.webNavigation.onBeforeNavigate.addListener(async (details) => {
     
     // Check if controlled (time-limited)
     if (butterflyAPI.isControlled(url)) {
-      const domain = butterflyAPI.extractDomain(url);
+      const domain = butterflyAPI.controlledRule(url);
       const canAccess = await butterflyAPI.checkTimeLimit(domain, details.tabId);
       
       if (!canAccess) {
@@ -185,8 +485,7 @@ chrome.webNavigation.onBeforeNavigate.addListener(async (details) => {
         
         // Log time limit exceeded
         try {
-          const tab = await chrome.tabs.get(details.tabId);
-          await butterflyAPI.logActivity(url, 'Time Limit Exceeded', true, details.tabId);
+          butterflyAPI.logActivity(url, 'Time Limit Exceeded', true, details.tabId);
         } catch (error) {
           console.error('Error logging time limit:', error);
         }
@@ -216,57 +515,49 @@ chrome.webNavigation.onCompleted.addListener(async (details) => {
     // Log activity
     try {
       const tab = await chrome.tabs.get(details.tabId);
-      await butterflyAPI.logActivity(url, tab.title || 'Unknown Page', false, details.tabId);
+      butterflyAPI.logActivity(url, tab.title || 'Unknown Page', false, details.tabId);
     } catch (error) {
       console.error('Error logging navigation:', error);
     }
-    
-    // Start time tracking for controlled sites
-    if (butterflyAPI.isControlled(url)) {
-      const domain = butterflyAPI.extractDomain(url);
-      butterflyAPI.timeTracking.set(details.tabId, {
-        domain: domain,
-        startTime: Date.now()
-      });
-    }
   }
 });
 
-// Track tab removal to update time usage
-chrome.tabs.onRemoved.addListener(async (tabId) => {
-  if (butterflyAPI.timeTracking.has(tabId)) {
-    const tracking = butterflyAPI.timeTracking.get(tabId);
-    const duration = Math.floor((Date.now() - tracking.startTime) / 1000); // seconds
-    
-    if (duration > 0) {
-      await butterflyAPI.updateTimeUsage(tracking.domain, duration);
-      console.log(`Updated time usage for ${tracking.domain}: ${duration} seconds`);
-    }
-    
-    butterflyAPI.timeTracking.delete(tabId);
+// Record the tab's visit (and its controlled-site time) when it closes
+chrome.tabs.onRemoved.addListener((tabId) => {
+  butterflyAPI.closeVisit(tabId);
+});
+
+// Only the tab in front accrues time: switching tabs, leaving the browser or
+// going idle stops the clock on the visit that was showing
+chrome.tabs.onActivated.addListener((activeInfo) => {
+  butterflyAPI.setActiveTab(activeInfo.tabId);
+});
+
+chrome.windows.onFocusChanged.addListener(async (windowId) => {
+  if (windowId === chrome.windows.WINDOW_ID_NONE) {
+    butterflyAPI.setActiveTab(null);
+  } else {
+    await butterflyAPI.refreshActiveTab();
   }
 });
 
-// Track tab activation changes
-chrome.tabs.onActivated.addListener(async (activeInfo) => {
-  // Stop tracking for previously active tab
-  for (const [tabId, tracking] of butterflyAPI.timeTracking.entries()) {
-    if (tabId !== activeInfo.tabId) {
-      const duration = Math.floor((Date.now() - tracking.startTime) / 1000);
-      if (duration > 0) {
-        await butterflyAPI.updateTimeUsage(tracking.domain, duration);
-      }
-      tracking.startTime = Date.now(); // Reset start time
-    }
+chrome.idle.onStateChanged.addListener(async (state) => {
+  if (state === 'active') {
+    await butterflyAPI.refreshActiveTab();
+  } else {
+    butterflyAPI.setActiveTab(null);
   }
 });
 
 // Listen for storage changes to update policies
 chrome.storage.onChanged.addListener(async (changes, namespace) => {
   if (namespace === 'sync' && changes.butterflyHashKey) {
+    butterflyAPI.stopPolicyStream();
+    butterflyAPI.timeBudget = null;
     await butterflyAPI.loadHashKey();
     if (butterflyAPI.hashKey) {
       await butterflyAPI.loadPolicies();
+      butterflyAPI.startPolicyStream();
     }
   }
 });
@@ -282,9 +573,20 @@ function keepAlive() {
 
 keepAlive();
 
-// Periodic policy refresh
+// Periodic policy refresh (fallback when the policy stream is down)
 setInterval(async () => {
   if (butterflyAPI.hashKey) {
     await butterflyAPI.loadPolicies();
+    butterflyAPI.startPolicyStream();
   }
 }, 5 * 60 * 1000); // Every 5 minutes
+
+// Periodic activity upload (also triggered early when the buffer fills up)
+setInterval(() => {
+  butterflyAPI.flushActivity();
+}, ACTIVITY_FLUSH_INTERVAL);
+
+// Write accumulated time usage back to storage
+setInterval(() => {
+  butterflyAPI.persistTimeUsage();
+}, TIME_USAGE_PERSIST_INTERVAL);
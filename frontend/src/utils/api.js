@@ -39,7 +39,18 @@ api.interceptors.response.use(
 
 // API functions
 export const studentAPI = {
-  getAll: () => api.get('/api/students'),
+  // The roster is paginated server-side; follow next_cursor until every page is loaded
+  getAll: async () => {
+    const students = [];
+    let cursor = null;
+    do {
+      const response = await api.get('/api/students', { params: { limit: 500, cursor } });
+      students.push(...response.data.students);
+      cursor = response.data.next_cursor;
+    } while (cursor);
+    return { data: { students } };
+  },
+  getPage: (params) => api.get('/api/students', { params }),
   create: (student) => api.post('/api/students', student),
   getById: (id) => api.get(`/api/students/${id}`),
 };
@@ -51,7 +62,8 @@ export const policyAPI = {
 
 export const analyticsAPI = {
   getUsage: () => api.get('/api/dashboard/usage'),
-  getStudentActivity: () => api.get('/api/dashboard/students/activity'),
+  getStudentActivity: (params) => api.get('/api/dashboard/students/activity', { params }),
+  getUsageLogs: (params) => api.get('/api/dashboard/usage/logs', { params }),
 };
 
 export default api;
@@ -5,6 +5,8 @@ class ButterflyAPI {
     this.baseURL = 'http://localhost:8001/api';
     this.hashKey = null;
     this.policies = null;
+    this.matcher = null;
+    this.matcherPolicies = null; // Policies object the matcher was built from
     this.loadHashKey();
   }
 
@@ -40,18 +42,31 @@ class ButterflyAPI {
     if (!this.hashKey) return null;
 
     try {
+      const stored = await chrome.storage.local.get(['butterflyPolicies', 'butterflyPoliciesETag']);
+      const headers = {
+        'Content-Type': 'application/json',
+      };
+      // Ask the server to skip the body if our stored copy is current
+      if (stored.butterflyPolicies && stored.butterflyPoliciesETag) {
+        headers['If-None-Match'] = stored.butterflyPoliciesETag;
+      }
+
       const response = await fetch(`${this.baseURL}/extension/policy`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
+        headers: headers,
         body: JSON.stringify({ hash_key: this.hashKey })
       });
 
-      if (response.ok) {
+      if (response.status === 304) {
+        this.policies = stored.butterflyPolicies;
+        return this.policies;
+      } else if (response.ok) {
         this.policies = await response.json();
         // Store policies locally for offline access
-        await chrome.storage.local.set({ butterflyPolicies: this.policies });
+        await chrome.storage.local.set({
+          butterflyPolicies: this.policies,
+          butterflyPoliciesETag: response.headers.get('ETag')
+        });
         return this.policies;
       } else {
         console.error('Failed to load policies:', response.status);
@@ -94,24 +109,25 @@ class ButterflyAPI {
     }
   }
 
+  // Domain matcher for the current policies, rebuilt only when they change
+  getMatcher() {
+    if (this.matcherPolicies !== this.policies) {
+      this.matcher = DomainMatcher.fromPolicies(this.policies);
+      this.matcherPolicies = this.policies;
+    }
+    return this.matcher;
+  }
+
   // Check if URL is blocked
   isBlocked(url) {
     if (!this.policies) return false;
-
-    const domain = this.extractDomain(url);
-    return this.policies.blocked_sites.some(blocked => 
-      domain.includes(blocked) || blocked.includes(domain)
-    );
+    return this.getMatcher().matchBlocked(url) !== null;
   }
 
   // Check if URL is controlled (time-limited)
   isControlled(url) {
     if (!this.policies) return false;
-
-    const domain = this.extractDomain(url);
-    return this.policies.controlled_sites.some(controlled => 
-      domain.includes(controlled) || controlled.includes(domain)
-    );
+    return this.getMatcher().matchControlled(url) !== null;
   }
 
   // Get allowed sites
@@ -0,0 +1,70 @@
+// Domain matching shared by the background worker and extension pages.
+// Mirrors backend/domain_matcher.py: a rule matches a host when it equals the
+// host or is a suffix of it on a label boundary ("x.com" matches "api.x.com"
+// but not "box.com"). Lookups cost one Set probe per label of the host.
+
+class DomainMatcher {
+  static FORMAT = 'suffix-set/1';
+
+  constructor(blocked = [], controlled = [], precompiled = false) {
+    this.blocked = DomainMatcher.toRuleSet(blocked, precompiled);
+    this.controlled = DomainMatcher.toRuleSet(controlled, precompiled);
+  }
+
+  // Use the matcher compiled by the server when present, otherwise compile the raw lists
+  static fromPolicies(policies) {
+    const compiled = policies && policies.matcher;
+    if (compiled && compiled.format === DomainMatcher.FORMAT) {
+      return new DomainMatcher(compiled.blocked, compiled.controlled, true);
+    }
+    return new DomainMatcher(policies?.blocked_sites || [], policies?.controlled_sites || []);
+  }
+
+  static toRuleSet(domains, precompiled) {
+    if (precompiled) return new Set(domains);
+    return new Set(domains.map(DomainMatcher.normalizeHost).filter(Boolean));
+  }
+
+  static normalizeHost(value) {
+    let host = (value || '').trim().toLowerCase();
+    if (host.includes('://')) {
+      try {
+        host = new URL(host).hostname;
+      } catch (error) {
+        return '';
+      }
+    } else {
+      host = host.split('/')[0].split('?')[0].split(':')[0];
+    }
+    host = host.replace(/^\.+|\.+$/g, '');
+    for (const prefix of ['*.', 'www.']) {
+      if (host.startsWith(prefix)) {
+        host = host.slice(prefix.length);
+      }
+    }
+    return host;
+  }
+
+  static matchSuffix(rules, host) {
+    let start = 0;
+    while (true) {
+      const suffix = host.slice(start);
+      if (rules.has(suffix)) return suffix;
+      const dot = host.indexOf('.', start);
+      if (dot < 0) return null;
+      start = dot + 1;
+    }
+  }
+
+  matchBlocked(url) {
+    const host = DomainMatcher.normalizeHost(url);
+    return host ? DomainMatcher.matchSuffix(this.blocked, host) : null;
+  }
+
+  matchControlled(url) {
+    const host = DomainMatcher.normalizeHost(url);
+    return host ? DomainMatcher.matchSuffix(this.controlled, host) : null;
+  }
+}
+
+globalThis.DomainMatcher = DomainMatcher;